@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Summary tables maintained while the elements are loaded.
+
+AggregateCollector counts the elements per type, per user and per tag
+key/value (and a few tag pairs, such as the cuisine of each amenity) as the
+shaped elements stream by, and adds the counts to the summary tables at the
+end of the load. osc_update subtracts the counts of the elements it
+replaces or deletes and adds those of the new versions, so the dashboard
+queries (top contributors, amenities, cuisines, bus and tram stops) become
+lookups in small tables instead of full-table aggregates. The elements
+without a user are counted under the empty user name, since a NULL in the
+primary key of summary_users would never match the UPSERT.
+"""
+
+from collections import Counter
+
+
+# (key, key) pairs counted together when an element has both tags
+TAG_PAIRS = [('amenity', 'cuisine')]
+
+SQL_AGGREGATES = """
+CREATE TABLE IF NOT EXISTS summary_elements (
+    element_type TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS summary_users (
+    user TEXT NOT NULL DEFAULT '',
+    element_type TEXT,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user, element_type)
+);
+
+CREATE TABLE IF NOT EXISTS summary_tags (
+    element_type TEXT,
+    key TEXT,
+    value TEXT,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (element_type, key, value)
+);
+
+CREATE TABLE IF NOT EXISTS summary_tag_pairs (
+    element_type TEXT,
+    key1 TEXT,
+    value1 TEXT,
+    key2 TEXT,
+    value2 TEXT,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (element_type, key1, value1, key2, value2)
+);
+"""
+
+# element type -> (main table, tag table)
+ELEMENT_TABLES = {'node': ('nodes', 'nodes_tags'), 'way': ('ways', 'ways_tags')}
+
+
+class AggregateCollector(object):
+    """
+    Count elements, users and tags of shaped elements. Called on each batch
+    of shaped elements, so it can be used as a write_shaped transform.
+    """
+
+    def __init__(self, tag_pairs=TAG_PAIRS):
+        self.tag_pairs = tag_pairs
+        self.elements = Counter()
+        self.users = Counter()
+        self.tags = Counter()
+        self.pairs = Counter()
+
+    def add(self, element_type, user, tags, sign=1):
+        """
+        Count one element.
+        Args:
+            element_type (str): 'node' or 'way'
+            user (str): user of the element, None for an anonymous element
+            tags (list): (key, value) of the element tags
+            sign (int): 1 to add the element, -1 to remove it
+        """
+        self.elements[element_type] += sign
+        self.users[(user if user is not None else '', element_type)] += sign
+        values = {}
+        for key, value in tags:
+            self.tags[(element_type, key, value)] += sign
+            values[key] = value
+        for key1, key2 in self.tag_pairs:
+            if key1 in values and key2 in values:
+                self.pairs[(element_type, key1, values[key1], key2, values[key2])] += sign
+
+    def __call__(self, batch):
+        for el in batch:
+            for element_type, tags_field in (('node', 'node_tags'), ('way', 'way_tags')):
+                if element_type in el:
+                    self.add(element_type, el[element_type].get('user'),
+                             [(tag['key'], tag['value']) for tag in el[tags_field]])
+
+    def subtract_existing(self, conn, element_type, ids):
+        """Remove the counts of elements currently stored in the database"""
+        table, tags_table = ELEMENT_TABLES[element_type]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            users = dict(conn.execute("SELECT id, user FROM %s WHERE id IN (%s)" % (table, marks), chunk))
+            tags = {}
+            for element_id, key, value in conn.execute(
+                    "SELECT id, key, value FROM %s WHERE id IN (%s)" % (tags_table, marks), chunk):
+                tags.setdefault(element_id, []).append((key, value))
+            for element_id, user in users.items():
+                self.add(element_type, user, tags.get(element_id, []), sign=-1)
+
+    def close(self):
+        pass
+
+    def write(self, conn):
+        """Add the collected counts to the summary tables and reset them"""
+        create_aggregate_tables(conn)
+        conn.executemany(
+            "INSERT INTO summary_elements VALUES (?, ?) ON CONFLICT (element_type) "
+            "DO UPDATE SET count = count + excluded.count",
+            [(k, n) for k, n in self.elements.items() if n])
+        conn.executemany(
+            "INSERT INTO summary_users VALUES (?, ?, ?) ON CONFLICT (user, element_type) "
+            "DO UPDATE SET count = count + excluded.count",
+            [k + (n,) for k, n in self.users.items() if n])
+        conn.executemany(
+            "INSERT INTO summary_tags VALUES (?, ?, ?, ?) ON CONFLICT (element_type, key, value) "
+            "DO UPDATE SET count = count + excluded.count",
+            [k + (n,) for k, n in self.tags.items() if n])
+        conn.executemany(
+            "INSERT INTO summary_tag_pairs VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (element_type, key1, value1, key2, value2) "
+            "DO UPDATE SET count = count + excluded.count",
+            [k + (n,) for k, n in self.pairs.items() if n])
+        for table in ('summary_users', 'summary_tags', 'summary_tag_pairs'):
+            conn.execute("DELETE FROM %s WHERE count <= 0" % table)
+        self.__init__(self.tag_pairs)
+
+
+def create_aggregate_tables(conn):
+    """Create the summary tables if they do not exist"""
+    for statement in SQL_AGGREGATES.split(';'):
+        if statement.strip():
+            conn.execute(statement)
+
+
+def has_aggregates(conn):
+    """Return True if the database has summary tables"""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'summary_elements'").fetchone() is not None
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed on-disk cache of the audit results.
+
+An audit result is stored under the sha256 of
+
+    audit name, sha256 of the OSM file content, hash of the rule tables,
+    element filter criteria
+
+so a repeated audit of an unchanged file with unchanged rules is read back
+from the cache instead of parsing the file again, and changing either the
+file or a rule table (expected, mapping_street, mapping_city, ..., or the
+code of the correction functions) simply misses the old entries. The
+results are pickled in CACHE_DIR, together with what the audit printed,
+which is printed again on a hit. Once the cache grows over max_bytes the
+least recently used entries are removed.
+
+    street_types = audit_street(osmfile)               # parses the file
+    street_types = audit_street(osmfile)               # read from the cache
+    street_types = audit_street(osmfile, cache=False)  # always parses
+"""
+
+import functools
+import hashlib
+import inspect
+import io
+import marshal
+import os
+import pickle
+import sys
+from contextlib import redirect_stdout
+
+
+CACHE_DIR = ".audit_cache"
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+HASH_CHUNK = 1024 * 1024
+
+
+def _update_rules_hash(digest, obj):
+    """Feed a canonical serialization of a rule table into digest"""
+    if isinstance(obj, dict):
+        digest.update(b'd%d' % len(obj))
+        for key in sorted(obj, key=repr):
+            _update_rules_hash(digest, key)
+            _update_rules_hash(digest, obj[key])
+    elif isinstance(obj, (set, frozenset)):
+        digest.update(b's%d' % len(obj))
+        for item in sorted(obj, key=repr):
+            _update_rules_hash(digest, item)
+    elif isinstance(obj, (list, tuple)):
+        digest.update(b'l%d' % len(obj))
+        for item in obj:
+            _update_rules_hash(digest, item)
+    elif callable(obj) and hasattr(obj, '__code__'):
+        # a correction function changes with its code
+        code = marshal.dumps(obj.__code__)
+        digest.update(b'f%d' % len(code))
+        digest.update(code)
+    else:
+        text = repr(obj).encode('utf-8')
+        digest.update(b'r%d' % len(text))
+        digest.update(text)
+
+
+def rules_hash(rules):
+    """
+    Hash the rule tables and correction functions an audit depends on.
+    Args:
+                rules (tuple): tables (dict, list, set, ...) and functions
+    Returns:
+                str: hex sha256
+    """
+    digest = hashlib.sha256()
+    _update_rules_hash(digest, rules)
+    return digest.hexdigest()
+
+
+# (path, size, mtime) -> content hash, so a file is hashed once per process
+_FILE_HASHES = {}
+
+
+def file_hash(path):
+    """Return the hex sha256 of the content of a file"""
+    st = os.stat(path)
+    stat_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    cached = _FILE_HASHES.get(stat_key)
+    if cached is not None:
+        return cached
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    _FILE_HASHES[stat_key] = digest.hexdigest()
+    return _FILE_HASHES[stat_key]
+
+
+def _filter_key(element_filter):
+    if element_filter is None:
+        return None
+    tags = element_filter.tags
+    return (element_filter.bbox, sorted(tags.items()) if tags is not None else None,
+            element_filter.postcode_range)
+
+
+class _Tee(io.TextIOBase):
+    """Text stream writing to another stream while keeping a copy"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.copy = io.StringIO()
+
+    def write(self, text):
+        self.copy.write(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class AuditCache(object):
+    """
+    Directory of pickled audit results, bounded in size.
+    Args:
+                cache_dir (str): directory of the cache entries
+                max_bytes (int): size of the entries above which the least
+                                 recently used ones are removed
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, name, osmfile, rules, element_filter=None):
+        """Return the cache key of an audit of osmfile"""
+        digest = hashlib.sha256()
+        for part in (name, file_hash(osmfile), rules_hash(rules), repr(_filter_key(element_filter))):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def get(self, key):
+        """Return (True, entry) for a cached key, (False, None) otherwise"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as entry_file:
+                entry = pickle.load(entry_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        # the modification time orders the entries for the eviction
+        os.utime(path)
+        return True, entry
+
+    def put(self, key, entry):
+        """Store an entry atomically, then evict down to max_bytes"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as entry_file:
+            pickle.dump(entry, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pickle'):
+                st = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((st.st_mtime_ns, st.st_size, name))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+    def clear(self):
+        """Remove every entry"""
+        if os.path.isdir(self.cache_dir):
+            for _, _, name in self._entries():
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+# Cache used by the audits, None to disable caching
+AUDIT_CACHE = AuditCache()
+
+
+def configure_audit_cache(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """Replace the audit cache, None as cache_dir disables it"""
+    global AUDIT_CACHE
+    AUDIT_CACHE = AuditCache(cache_dir, max_bytes) if cache_dir is not None else None
+
+
+def cached_audit(name, rules):
+    """
+    Decorate an audit(osmfile, ..., element_filter=None) to cache its result.
+    Args:
+                name (str): name of the audit, part of the cache key
+                rules (callable): returns the rule tables and functions the audit
+                                  depends on, called on every audit so tables
+                                  changed in place are seen
+    Returns:
+                callable: decorator; the decorated audit takes cache=False to
+                          bypass the cache
+    """
+    def decorate(audit):
+        signature = inspect.signature(audit)
+
+        @functools.wraps(audit)
+        def wrapper(osmfile, *args, cache=True, **kwargs):
+            audit_cache = AUDIT_CACHE
+            if not cache or audit_cache is None or not isinstance(osmfile, str):
+                return audit(osmfile, *args, **kwargs)
+
+            arguments = signature.bind(osmfile, *args, **kwargs).arguments
+            # the file is keyed by its content, the filter by its criteria
+            options = sorted((arg, value) for arg, value in arguments.items()
+                             if arg not in ('osmfile', 'element_filter'))
+            key = audit_cache.key(name, osmfile, (options, rules()),
+                                  arguments.get('element_filter'))
+            hit, entry = audit_cache.get(key)
+            if hit:
+                result, printed = entry
+                sys.stdout.write(printed)
+                return result
+
+            tee = _Tee(sys.stdout)
+            with redirect_stdout(tee):
+                result = audit(osmfile, *args, **kwargs)
+            audit_cache.put(key, (result, tee.copy.getvalue()))
+            return result
+        return wrapper
+    return decorate
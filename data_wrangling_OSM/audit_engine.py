@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Single pass audit of an OSM file.
+
+Every audit is registered as a handler for one tag key. run_audits streams
+the file once through osm_stream.iter_tags and dispatches each secondary tag
+to the auditors registered for its key, so all the audits share the same
+memory-bounded parse. What a handler returns other than None, such as the
+postal codes outside the Mestre area, is collected in the report too. The
+reports are cached on disk, keyed by the content of the file and the rules
+of the auditors, see audit_cache.
+"""
+
+from collections import defaultdict
+
+from osm_stream import iter_tags
+from audit_cache import cached_audit
+from correction_rules import refresh_rule_sets
+from audit_street import audit_street_type, street_audit_rules
+from audit_postal import audit_postal_code, postcode_audit_rules
+from audit_suburb import audit_city_name, city_audit_rules
+from audit_province import audit_province_name, province_audit_rules
+from audit_phone_number import audit_phone_num, phone_audit_rules
+
+
+# Registry of auditors: name -> (tag key, report factory, handler, rules, returned)
+AUDITORS = {}
+
+
+def register_auditor(name, tag_key, factory, handler, rules=None, returned=None):
+    """
+    Register an auditor for a tag key.
+    Args:
+                name (str): name of the auditor, used as key in the report
+                tag_key (str): full "k" attribute of the secondary tags to audit
+                factory (callable): returns an empty report for the auditor
+                handler (callable): handler(report, value) updates the report
+                rules (callable): returns the rule tables and functions the handler
+                                  depends on, see audit_cache.cached_audit
+                returned (str): key of the report listing the values the handler
+                                returns other than None, not collected if None
+    """
+    AUDITORS[name] = (tag_key, factory, handler, rules, returned)
+
+
+register_auditor('street', 'addr:street', lambda: defaultdict(set), audit_street_type,
+                 street_audit_rules)
+register_auditor('postcode', 'addr:postcode', lambda: defaultdict(set), audit_postal_code,
+                 postcode_audit_rules, returned='postcode_outside')
+register_auditor('city', 'addr:city', lambda: defaultdict(set), audit_city_name,
+                 city_audit_rules)
+register_auditor('province', 'addr:province', list, audit_province_name, province_audit_rules)
+register_auditor('phone', 'phone', dict, audit_phone_num, phone_audit_rules)
+
+
+def auditors_rules():
+    """Registered auditors and their rules, see audit_cache"""
+    return [(name, tag_key, factory, handler, rules() if rules is not None else None, returned)
+            for name, (tag_key, factory, handler, rules, returned) in sorted(AUDITORS.items())]
+
+
+@cached_audit('run_audits', auditors_rules)
+def run_audits(osmfile, names=None, element_filter=None):
+    """
+    Run the registered auditors over an OSM file in a single parse.
+    Args:
+                osmfile (str): file path
+                names (list): auditors to run, all registered auditors if None
+                element_filter (ElementFilter): only audit the elements passing this
+                                                filter, see element_filter
+    Returns:
+                dict: report of each auditor, keyed by auditor name, and the
+                      values returned by its handler in order, keyed by the
+                      returned name of the auditor
+    """
+    if names is None:
+        names = list(AUDITORS)
+    refresh_rule_sets()
+
+    report = {}
+    dispatch = defaultdict(list)
+    for name in names:
+        tag_key, factory, handler, _, returned = AUDITORS[name]
+        report[name] = factory()
+        if returned is not None:
+            report[returned] = []
+        dispatch[tag_key].append((handler, report[name],
+                                  report[returned] if returned is not None else None))
+
+    for _, key, value in iter_tags(osmfile, element_filter=element_filter):
+        handlers = dispatch.get(key)
+        if handlers:
+            for handler, auditor_report, results in handlers:
+                result = handler(auditor_report, value)
+                if result is not None and results is not None:
+                    results.append(result)
+
+    return report
@@ -1,10 +1,18 @@
 # Audit phone number  
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
+from itertools import islice
+
+from osm_stream import iter_tags
+from audit_cache import cached_audit
   
 PHONENUM = re.compile(r'\+39\s\d{3}\s\d{6,7}')
+FIVE_DIGITS_RE = re.compile(r'\d{5}')
+SIX_DIGITS_RE = re.compile(r'\d{6}')
+PLUS_SPACE_RE = re.compile(r'\+ 3')
+COUNTRY_CODE_RE = re.compile(r'\+39|39')
+COUNTRY_CODE_NO_PLUS_RE = re.compile(r'39\d{3,}')
 
 def correct_phone_num(phone_num):
     """
@@ -21,32 +29,32 @@ def correct_phone_num(phone_num):
     if m is None:
         
         # remove postal code 
-        if re.match(r'\d{5}', phone_num) is not None:
-            if re.match(r'\d{6}', phone_num) is None:
+        if FIVE_DIGITS_RE.match(phone_num) is not None:
+            if SIX_DIGITS_RE.match(phone_num) is None:
                 return None
         
         # Convert all dashes to spaces
         if "-" in phone_num:
-            phone_num = re.sub("-", " ", phone_num)
+            phone_num = phone_num.replace("-", " ")
          
         # remove space between + and 39
-        if re.match(r'\+ 3',phone_num[:3]) is not None:
-            phone_num = re.sub(" ", "", phone_num, count=1)
+        if PLUS_SPACE_RE.match(phone_num[:3]) is not None:
+            phone_num = phone_num.replace(" ", "", 1)
             
         # Substitute 00 with +
         if phone_num[:2]=='00':
             phone_num = '+' + phone_num[2:]
             
         # Add coutry code
-        if re.match(r'\+39|39',phone_num) is None:
+        if COUNTRY_CODE_RE.match(phone_num) is None:
             phone_num = "+39" + phone_num
             
         # Remove whitespaces
         if " " in phone_num:
-            phone_num = re.sub(" ", "", phone_num)
+            phone_num = phone_num.replace(" ", "")
             
         # Add + in country code
-        if re.match(r'39\d{3,}', phone_num) is not None:
+        if COUNTRY_CODE_NO_PLUS_RE.match(phone_num) is not None:
             phone_num = "+" + phone_num
             
         # Check number in the 4th position
@@ -63,28 +71,42 @@ def correct_phone_num(phone_num):
     return phone_num
 
 
-def audit_phone(osmfile):
+def audit_phone_num(phone_corrections, phone_num):
+    """
+    Record the correction of a phone number if the number changes
+    Args:
+        phone_corrections (dict): map of original to corrected phone numbers
+        phone_num (str): phone number
+    """
+    new_phone = correct_phone_num(phone_num)
+    if phone_num != new_phone:
+        phone_corrections[phone_num] = new_phone
+
+
+def phone_audit_rules():
+    """Patterns and functions the phone audit depends on, see audit_cache"""
+    return (PHONENUM, FIVE_DIGITS_RE, SIX_DIGITS_RE, PLUS_SPACE_RE, COUNTRY_CODE_RE,
+            COUNTRY_CODE_NO_PLUS_RE, correct_phone_num, audit_phone_num)
+
+
+@cached_audit('phone', phone_audit_rules)
+def audit_phone(osmfile, element_filter=None):
     """
     Check phone numbers and correct for the right format
     Args:
         osmfile (str): file path
+        element_filter (ElementFilter): only audit the elements passing this filter
+    Returns:
+        dict: map of original to corrected phone numbers
     """
-    phone_list = []
-    phone_file = open(osmfile, encoding="utf8")
-    counter = 0
+    phone_corrections = {}
+    for _, key, value in iter_tags(osmfile, element_filter=element_filter):
+        if key == 'phone':
+            audit_phone_num(phone_corrections, value)
+
     counter_max = 5
     print('Corrected phone numbers (first 5):\n') 
-    for event, elem in ET.iterparse(phone_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if tag.attrib['k'] == 'phone':
-                    old_phone_num = tag.attrib['v']
-                    new_phone = correct_phone_num(old_phone_num)
-                    if counter<counter_max:  
-                        if old_phone_num!=new_phone:
-                            print(old_phone_num + '-->' + new_phone)
-                            counter = counter + 1
-                   # if phone_num not in phone_list:
-                    #    phone_list.append(phone_num)
+    for old_phone_num, new_phone in islice(phone_corrections.items(), counter_max):
+        print(old_phone_num + '-->' + str(new_phone))
                     
-    phone_file.close()
\ No newline at end of file
+    return phone_corrections
@@ -1,9 +1,12 @@
 # Audit post code
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
 
+from osm_stream import iter_tags
+from correction_rules import rule_set
+from audit_cache import cached_audit
+
 
 mapping_postal_code = { "PontedeiPugni": "30123",
                         "Ponte dei Pugni": "30123",
@@ -15,11 +18,42 @@ POSTCODE = re.compile(r'[A-z]\d[A-z]\s?\d[A-z]\d')
 min_code = 30121
 max_code = 30176
 
-def audit_postcode(osmfile):
+def audit_postal_code(postal_code_wrong, post_code):
+    """
+    Add a postal code to the dictionary of wrong postal codes if it is not numeric
+         Args:
+                   postal_code_wrong (dict): dictionary with wrong postal codes
+                   post_code (str): postal code
+         Returns:
+                   int: postal code if it is numeric but outside Mestre area, None otherwise
+    """
+
+    post_code = post_code.strip().replace(" ", "")
+    m = POSTCODE.match(post_code)
+    if m is None:
+        
+        aa = [int(s) for s in post_code.split() if s.isdigit()]
+        if aa:
+            
+            if aa[0]<min_code or aa[0]>max_code:
+                return aa[0]
+        else:
+            postal_code_wrong[post_code].add(post_code)
+    return None
+
+
+def postcode_audit_rules():
+    """Rule tables and functions the postal code audit depends on, see audit_cache"""
+    return (POSTCODE, min_code, max_code, audit_postal_code)
+
+
+@cached_audit('postcode', postcode_audit_rules)
+def audit_postcode(osmfile, element_filter=None):
     """
     Audit postal code
          Args:
                    osmfile (str): OSM file path
+                   element_filter (ElementFilter): only audit the elements passing this filter
          Returns:
                    postal_code_wrong (dict): dictionary with wrong postal codes
     """
@@ -27,41 +61,22 @@ def audit_postcode(osmfile):
     postal_code_wrong = defaultdict(set)
     
     # loop through the OSM file to check postal codes
-    post_file = open(osmfile, encoding="utf8")
-
     counter = 0
     print('Postal codes outside Mestre area (first 5):')
-    for event, elem in ET.iterparse(post_file, events=("start",)):
+    for _, key, value in iter_tags(osmfile, element_filter=element_filter):
         
-        if elem.tag == "node" or elem.tag == "way":
+        if key == 'addr:postcode':
             
-            for tag in elem.iter("tag"):
-                
-                if tag.attrib['k'] == 'addr:postcode':
-                    
-                    post_code = re.sub(" ", "", tag.attrib['v'].strip())
-                    m = POSTCODE.match(post_code)
-                    if m is None:
-                        
-                        aa = [int(s) for s in post_code.split() if s.isdigit()]
-                        if aa:
-                            
-                            if aa[0]<min_code or aa[0]>max_code:
-                                
-                                if counter<5:
-
-                                    #if post_code not in postal_code_wrong
-                                    print('%d' %aa[0])
-                                    counter+=1
-                        else:
-                            postal_code_wrong[post_code].add(post_code)
-    post_file.close()
+            outside_code = audit_postal_code(postal_code_wrong, value)
+            if outside_code is not None and counter<5:
+                print('%d' %outside_code)
+                counter+=1
     return postal_code_wrong
 
 	
 def correct_postal_code(name, mapping):
     """
-         correct postal code
+         correct postal code with the postcode rules of correction_rules.json
          Args:
                    name (str): postal code
                    mapping (list): list of corrections
@@ -69,12 +84,4 @@ def correct_postal_code(name, mapping):
                    code_correct (str): correct postal code
     """
     
-    code_correct = name
-    
-    m = re.search(r'(\D+\d*)+',name)
-    if m:
-        code = m.group()
-        code_correct = re.sub(r'(\D+\d*)+',mapping[code], name, count = 1)
-        return code_correct
-    
-    return code_correct
\ No newline at end of file
+    return rule_set('postcode')(name, mapping)
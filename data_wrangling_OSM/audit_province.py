@@ -1,33 +1,48 @@
-import xml.etree.cElementTree as ET
 from collections import defaultdict
-import re
 import pprint
 
+from osm_stream import iter_tags
+from correction_rules import rule_set, load_specs, refresh_rule_sets
+from audit_cache import cached_audit
+
 # Audit province information
 def correct_province(name):
-    
-    if name=='VE':
-        name = 'Venezia'
-        
-    return name
+    """Correct a province name with the province rules of correction_rules.json"""
+    return rule_set('province')(name)
 
 
     
-def audit_prov(osmfile):
+def audit_province_name(province_list, name):
+    """
+    Add a corrected province name to the list of provinces found
+    Args:
+        province_list (list): province names found so far
+        name (str): province name
+    """
+    province = correct_province(name.strip().replace(" ", ""))
+    if province not in province_list:
+        province_list.append(province)
+
+
+def province_audit_rules():
+    """Rules and functions the province audit depends on, see audit_cache"""
+    return (load_specs()['province'], correct_province, audit_province_name)
+
+
+@cached_audit('province', province_audit_rules)
+def audit_prov(osmfile, element_filter=None):
     """
     Check province information
     Args:
         osmfile (str): file path
+        element_filter (ElementFilter): only audit the elements passing this filter
+    Returns:
+        list: province names found
     """
+    refresh_rule_sets()
     province_list = []
-    province_file = open(osmfile, encoding="utf8")
-    for event, elem in ET.iterparse(province_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if tag.attrib['k'] == 'addr:province':
-                    province = correct_province(re.sub(" ", "", tag.attrib['v'].strip()))
-                    if province not in province_list:
-                        province_list.append(province)
-                    
+    for _, key, value in iter_tags(osmfile, element_filter=element_filter):
+        if key == 'addr:province':
+            audit_province_name(province_list, value)
                     
-    province_file.close()
\ No newline at end of file
+    return province_list
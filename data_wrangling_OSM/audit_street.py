@@ -1,8 +1,11 @@
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
 
+from osm_stream import iter_tags
+from correction_rules import rule_set
+from audit_cache import cached_audit
+
 # String pattern for checking street name anomalies
 street_type_re = re.compile(r'(\S*)+\.?', re.I)
 # +: at least one match of the previous symbol 
@@ -46,37 +49,35 @@ def audit_street_type(street_types, street_name):
             street_types[street_type].add(street_name)
 
 
-def is_street_name(elem):
-    return (elem.attrib['k'] == "addr:street")
+def street_audit_rules():
+    """Rule tables and functions the street audit depends on, see audit_cache"""
+    return (expected, street_type_re, audit_street_type)
 
 
-def audit_street(osmfile):
+@cached_audit('street', street_audit_rules)
+def audit_street(osmfile, element_filter=None):
     
     """
     Open OSM file, find and call auditing function for every tag with street names.
     Args:
                 osmfile (string): file path
+                element_filter (ElementFilter): only audit the elements passing this filter
     Returns:
                 dict: dictionary with unexpected street types
     
     """
     
-    osm_file = open(osmfile, encoding="utf8")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+    for _, key, value in iter_tags(osmfile, element_filter=element_filter):
+        if key == "addr:street":
+            audit_street_type(street_types, value)
     return street_types
 
 
 def correct_street_name(name, mapping):
     
     """
-         Correct error in the street name
+         Correct error in the street name with the street rules of correction_rules.json
          Args:
                    name (string): street name
                    mapping (dict): dictionary with map of corrections 
@@ -84,29 +85,4 @@ def correct_street_name(name, mapping):
                    name_correct (string): correct street name
     """
     
-    name_correct = name
-    
-    m = street_type_re.search(name)
-    if m:
-        street_type = m.group()
-        if street_type =='Isola':
-            name_correct = re.sub("Nuova", "Nova",name)
-        elif street_type =='Lista':
-            name_correct = 'Rio Terà ' + name
-            name_correct = re.sub(r'(\n)+', "", name_correct)
-        elif street_type =='Stazione':
-            name_correct = 'Cannaregio'
-        elif street_type == 'Dorsoduro,':
-            name_correct = re.sub(r'(\,+\D+)', "", name)
-        elif street_type == 'La':
-            name_correct = 'Fondamenta Sant Eufemia'
-        elif street_type in mapping:
-            name_correct = street_type_re.sub(mapping[street_type], name, count = 1)
-            
-            if street_type == 'Sestiere' or street_type == 'Carbonera':
-                name_correct = re.sub(r'\s+',"", name_correct, count = 1)
-            elif street_type == 'salizada':
-                name_correct = re.sub(r'(samuele)+\D+[0-9]+','Samuele', name_correct, count = 1)
-
-    return name_correct
-
+    return rule_set('street')(name, mapping)
@@ -1,9 +1,11 @@
 # Audit city suburb name
-import xml.etree.cElementTree as ET
 from collections import defaultdict
-import re
 import pprint
 
+from osm_stream import iter_tags
+from correction_rules import rule_set
+from audit_cache import cached_audit
+
 mapping_city = {"Venice": "Venezia",
                 "Marghera VE": "Marghera",
                 "Venezia Mestre": "Mestre",
@@ -15,38 +17,47 @@ expected_suburb = ['Venezia', 'Oriago', 'Mestre', 'Favaro Veneto','Tessera',
                    'Marghera', 'Zelarino', 'Campalto', 'Malcontenta','Marcon',
 				   'Martellago','Mira','Olmo','Spinea']
 
-def audit_city(osmfile):
+
+def audit_city_name(suburb_list_wrong, city):
+    """
+    Add a suburb name to the dictionary of wrong names if it is not expected
+         Args:
+                   suburb_list_wrong (dict): dictionary with wrong suburb names
+                   city (str): suburb name
+    """
+    if city not in expected_suburb:
+        
+        suburb_list_wrong[city].add(city)
+
+
+def city_audit_rules():
+    """Rule tables and functions the suburb audit depends on, see audit_cache"""
+    return (expected_suburb, audit_city_name)
+
+
+@cached_audit('city', city_audit_rules)
+def audit_city(osmfile, element_filter=None):
     """
     Audit name of city suburb
          Args:
                    osmfile (str): OSM file path
+                   element_filter (ElementFilter): only audit the elements passing this filter
          Returns:
                    suburb_list_wrong (dict): dictionary with wrong postal codes
     """
     suburb_list_wrong = defaultdict(set)
-    city_file = open(osmfile, encoding="utf8")
     
-    for event, elem in ET.iterparse(city_file, events=("start",)):
+    for _, key, value in iter_tags(osmfile, element_filter=element_filter):
         
-        if elem.tag == "node" or elem.tag == "way":
-            
-            for tag in elem.iter("tag"):
-                
-                if tag.attrib['k'] == 'addr:city':
-                    
-                    city = tag.attrib['v']
-                    # province = re.sub(" ", "", tag.attrib['v'].strip())
-                    if city not in expected_suburb:
-                        
-                        suburb_list_wrong[city].add(city)
+        if key == 'addr:city':
+            audit_city_name(suburb_list_wrong, value)
                     
-    city_file.close()
     return suburb_list_wrong
     
     
 def correct_city_sub(name, mapping):
     """
-    correct suburb name
+    correct suburb name with the city rules of correction_rules.json
     Arg:
         name (str): suburb name
         mapping (dict): list of corrections
@@ -55,12 +66,4 @@ def correct_city_sub(name, mapping):
         name_correct (str): correct name
     
     """
-    name_correct = name
-    
-    m = re.search(r'(\D*\d*)+',name)
-    if m:
-        suburb = m.group()
-        if suburb not in expected_suburb:
-            name_correct = mapping[suburb]
-            
-    return name_correct
+    return rule_set('city')(name, mapping)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the OSM cleaning pipeline.
+
+Every benchmark runs on a synthetic dirty OSM file written by synthetic_osm
+and reports items processed, seconds, throughput and peak Python memory as
+one json object per line, so runs of different releases can be compared:
+
+    python benchmark.py --nodes 200000 --output before.jsonl
+    python benchmark.py --nodes 200000 --output after.jsonl
+    python benchmark.py --compare before.jsonl after.jsonl
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import create_RDBMS
+from audit_engine import run_audits
+from osm_stream import iter_tags
+from synthetic_osm import write_synthetic_osm
+from validation import validate_elements
+
+
+def bench_get_element(osm_path):
+    count = 0
+    for _ in create_RDBMS.get_element(osm_path, tags=('node', 'way')):
+        count += 1
+    return count
+
+
+def bench_shape_element(osm_path):
+    count = 0
+    for element in create_RDBMS.get_element(osm_path, tags=('node', 'way')):
+        create_RDBMS.shape_element(element)
+        count += 1
+    return count
+
+
+def bench_expat_backend(osm_path):
+    count = 0
+    for _ in create_RDBMS.iter_shaped(osm_path, backend='expat'):
+        count += 1
+    return count
+
+
+def bench_validate_element(shaped):
+    validate_elements(shaped)
+    return len(shaped)
+
+
+def bench_correctors(values, cached=True):
+    # iter_shaped filled the caches, start them empty so misses are timed too
+    if cached:
+        for corrector in create_RDBMS.CORRECTORS.values():
+            corrector.cache_clear()
+        correctors = create_RDBMS.CORRECTORS
+    else:
+        correctors = {key: corrector.corrector for key, corrector in create_RDBMS.CORRECTORS.items()}
+    count = 0
+    for key, value in values:
+        correctors[key](value)
+        count += 1
+    return count
+
+
+def bench_audits(osm_path, n_tags):
+    run_audits(osm_path, cache=False)
+    return n_tags
+
+
+def bench_process_map(osm_path, n_elements, backend='etree'):
+    create_RDBMS.process_map(osm_path, validate=True, backend=backend)
+    return n_elements
+
+
+def measure(name, func, *args, **kwargs):
+    """
+    Run a benchmark once for timing and once under tracemalloc for memory.
+    Returns:
+                dict: benchmark result
+    """
+    start = time.perf_counter()
+    items = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'benchmark': name,
+        'items': items,
+        'seconds': round(seconds, 4),
+        'items_per_sec': round(items / seconds, 1) if seconds else None,
+        'peak_mb': round(peak / 2.0 ** 20, 2),
+    }
+
+
+def run_benchmarks(n_nodes=100000, tag_density=0.5, dirty_ratio=0.3, seed=0):
+    """
+    Generate a synthetic OSM file and run every benchmark on it.
+    Args:
+                n_nodes (int): number of nodes of the synthetic file
+                tag_density (float): average number of secondary tags per element
+                dirty_ratio (float): fraction of the audited tags with a dirty value
+                seed (int): seed of the generator
+    Returns:
+                list: benchmark results
+    """
+    work_dir = tempfile.mkdtemp(prefix='osm_bench_')
+    cwd = os.getcwd()
+    try:
+        osm_path = os.path.join(work_dir, 'synthetic.osm')
+        write_synthetic_osm(osm_path, n_nodes, tag_density=tag_density,
+                            dirty_ratio=dirty_ratio, seed=seed)
+        # process_map writes its csv(s) in the current directory
+        os.chdir(work_dir)
+
+        shaped = [el for el in create_RDBMS.iter_shaped(osm_path, backend='expat')]
+        # raw values of the corrected tags, keyed like create_RDBMS.CORRECTORS
+        tags = list(iter_tags(osm_path))
+        values = [(k.split(':', 1)[-1], v) for _, k, v in tags]
+        values = [(key, value) for key, value in values if key in create_RDBMS.CORRECTORS]
+
+        results = [
+            measure('get_element', bench_get_element, osm_path),
+            measure('shape_element', bench_shape_element, osm_path),
+            measure('expat_backend', bench_expat_backend, osm_path),
+            measure('validate_element', bench_validate_element, shaped),
+            measure('correctors', bench_correctors, values),
+            measure('correctors_uncached', bench_correctors, values, cached=False),
+            measure('audits', bench_audits, osm_path, len(tags)),
+            measure('process_map', bench_process_map, osm_path, len(shaped)),
+            measure('process_map_expat', bench_process_map, osm_path, len(shaped), backend='expat'),
+        ]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for result in results:
+        result.update({'nodes': n_nodes, 'tag_density': tag_density, 'dirty_ratio': dirty_ratio})
+    return results
+
+
+def compare(before, after, threshold=0.1):
+    """
+    Compare two benchmark runs.
+    Args:
+                before (list): results of the reference run
+                after (list): results of the new run
+                threshold (float): relative throughput loss reported as regression
+    Returns:
+                list: (benchmark, throughput ratio, peak memory ratio, regression flag)
+    """
+    reference = {result['benchmark']: result for result in before}
+    rows = []
+    for result in after:
+        ref = reference.get(result['benchmark'])
+        if ref is None or not ref['items_per_sec'] or not result['items_per_sec']:
+            continue
+        speed = result['items_per_sec'] / ref['items_per_sec']
+        memory = result['peak_mb'] / ref['peak_mb'] if ref['peak_mb'] else None
+        rows.append((result['benchmark'], speed, memory, speed < 1 - threshold))
+    return rows
+
+
+def _load(path):
+    with open(path) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--tag-density', type=float, default=0.5)
+    parser.add_argument('--dirty-ratio', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='append the results to this json lines file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        regressions = 0
+        for name, speed, memory, regression in compare(*[_load(p) for p in args.compare]):
+            regressions += regression
+            print('%-20s throughput x%.2f  peak memory x%s%s' % (
+                name, speed, '%.2f' % memory if memory is not None else '-',
+                '  REGRESSION' if regression else ''))
+        return 1 if regressions else 0
+
+    results = run_benchmarks(args.nodes, args.tag_density, args.dirty_ratio, args.seed)
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
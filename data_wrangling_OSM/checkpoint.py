@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpointed, resumable csv processing with an optional quarantine.
+
+Every checkpoint_every elements the pending batch is written, the five csv
+files are flushed and a checkpoint is saved atomically as json:
+
+    {"input": ..., "input_size": ..., "elements": 120000, "last_id": "4003917",
+     "offset": 10483312, "outputs": {"nodes.csv": 7340125, ...}, "rejects": 0}
+
+offset is the byte offset of the start tag of the last element written, as
+reported by expat. A rerun with the same checkpoint path truncates the csv
+files back to the recorded positions, seeks to offset in the input, parses
+the rest wrapped in an <osm> root (like the ranges of parallel_map), checks
+that the first element is last_id and carries on after it, so resuming does
+not parse the part of the file already written. The checkpoint is removed
+once the whole file has been processed.
+
+In quarantine mode an element whose correction raises KeyError (e.g. an
+unknown postal code) or whose shaped rows fail validation is written to the
+reject file, one json object per line, instead of aborting the run:
+
+    process_map(file_in, validate=True, checkpoint='mestre.checkpoint.json',
+                quarantine=True)
+"""
+
+import codecs
+import json
+import os
+import xml.etree.cElementTree as ET
+from xml.parsers import expat
+
+from create_RDBMS import (shape_element, open_writers, _write_batch, CORRECTORS,
+                          OUTPUT_PATHS, VALIDATION_BATCH)
+from instrumentation import NULL_STATS
+from osm_stream import open_osm
+from validation import validate_elements, ValidationError, format_errors
+
+
+CHECKPOINT_EVERY = 100000
+REJECTS_PATH = "rejects.jsonl"
+READ_SIZE = 1024 * 1024
+OSM_START = b'<osm>'
+
+
+class _OffsetElementBuilder(object):
+    """expat callbacks building the top level Elements with the offset of their start tag"""
+
+    def __init__(self, parser, tags, base):
+        self.parser = parser
+        self.tags = tags
+        self.base = base
+        self.depth = 0
+        self.builder = None
+        self.offset = None
+        self.elements = []
+
+    def start_element(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            if name in self.tags:
+                self.builder = ET.TreeBuilder()
+                self.offset = self.base + self.parser.CurrentByteIndex
+        if self.builder is not None:
+            self.builder.start(name, attrs)
+
+    def end_element(self, name):
+        if self.builder is not None:
+            self.builder.end(name)
+            if self.depth == 2:
+                self.elements.append((self.offset, self.builder.close()))
+                self.builder = None
+        self.depth -= 1
+
+
+def iter_offset_elements(file_in, tags=('node', 'way'), offset=0):
+    """
+    Yield the top level elements of an OSM file with their byte offsets.
+    Args:
+                file_in (str): OSM file path, possibly .gz or .bz2
+                tags (tuple): top level tags to yield
+                offset (int): start parsing at this offset, which must be the start
+                              of a top level element; 0 parses the whole file
+    Yields:
+                tuple: (offset of the start tag in the uncompressed file, Element)
+    """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    # the rest of the file after offset is parsed after an <osm> start tag
+    builder = _OffsetElementBuilder(parser, tags, offset - len(OSM_START) if offset else 0)
+    parser.StartElementHandler = builder.start_element
+    parser.EndElementHandler = builder.end_element
+
+    osm_file = open_osm(file_in)
+    try:
+        if offset:
+            if osm_file.seekable():
+                osm_file.seek(offset)
+            else:
+                # decompressed input, the skipped part is still not parsed
+                remaining = offset
+                while remaining:
+                    skipped = osm_file.read(min(remaining, READ_SIZE))
+                    if not skipped:
+                        break
+                    remaining -= len(skipped)
+            parser.Parse(OSM_START, False)
+        while True:
+            data = osm_file.read(READ_SIZE)
+            parser.Parse(data, not data)
+            if builder.elements:
+                elements, builder.elements = builder.elements, []
+                for element in elements:
+                    yield element
+            if not data:
+                break
+    finally:
+        osm_file.close()
+
+
+def load_checkpoint(checkpoint_path, file_in):
+    """Return the saved checkpoint of file_in, or None to start from the beginning"""
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        state = json.load(checkpoint_file)
+    if state['input'] != os.path.abspath(file_in) or state['input_size'] != os.path.getsize(file_in):
+        raise ValueError("checkpoint %s was saved for another input file" % checkpoint_path)
+    return state
+
+
+def save_checkpoint(checkpoint_path, state):
+    """Write the checkpoint atomically"""
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(state, checkpoint_file, indent=2)
+    os.replace(tmp_path, checkpoint_path)
+
+
+class RejectWriter(object):
+    """Write the quarantined elements to a json lines file"""
+
+    def __init__(self, rejects_file):
+        self.rejects_file = rejects_file
+        self.count = 0
+
+    def reject(self, stage, error, element_type, element_id, element):
+        self.rejects_file.write(json.dumps({
+            'stage': stage, 'error': error, 'type': element_type, 'id': element_id,
+            'element': element,
+        }) + '\n')
+        self.count += 1
+
+
+def _quarantine_invalid(batch, rejects):
+    """Validate a batch, moving the invalid elements to the rejects"""
+    try:
+        validate_elements(batch)
+        return batch
+    except ValidationError:
+        pass
+    valid = []
+    for el in batch:
+        errors = validate_elements([el], fail_fast=False)
+        if errors:
+            element_type = 'node' if 'node' in el else 'way'
+            rejects.reject('validate', format_errors(errors), element_type,
+                           el[element_type].get('id'), el)
+        else:
+            valid.append(el)
+    return valid
+
+
+def _open_outputs(state, rejects_path):
+    """Open the csv and reject files, truncated back to the checkpoint if any"""
+    paths = OUTPUT_PATHS + [rejects_path]
+    if state is None:
+        return [codecs.open(path, 'w') for path in paths]
+    positions = [state['outputs'][path] for path in OUTPUT_PATHS] + [state['rejects']]
+    for path, position in zip(paths, positions):
+        os.truncate(path, position)
+    return [codecs.open(path, 'a') for path in paths]
+
+
+def process_map_resumable(file_in, validate, checkpoint_path=None, checkpoint_every=None,
+                          quarantine=False, rejects_path=REJECTS_PATH, stats=None):
+    """
+    Process each XML element and write to the csv(s), saving checkpoints.
+    Args:
+                file_in (str): OSM file path
+                validate (bool): validate the shaped elements against the schema
+                checkpoint_path (str): checkpoint file, resumed from if it exists
+                checkpoint_every (int): input elements between two checkpoints,
+                                        CHECKPOINT_EVERY if None
+                quarantine (bool): write the failing elements to rejects_path
+                                   instead of raising
+                rejects_path (str): json lines file of the quarantined elements
+                stats (PipelineStats): collects timings and counters of the run
+    Returns:
+                int: number of quarantined elements in this run
+    """
+    stats_or_null = stats if stats is not None else NULL_STATS
+    if checkpoint_every is None:
+        checkpoint_every = CHECKPOINT_EVERY
+    state = load_checkpoint(checkpoint_path, file_in)
+    outputs = _open_outputs(state, rejects_path)
+    try:
+        writers = open_writers(*outputs[:5], header=state is None)
+        rejects = RejectWriter(outputs[5])
+
+        done = 0
+        last_id = None
+        last_offset = 0
+        if state is None:
+            elements = iter_offset_elements(file_in)
+        else:
+            # the first element is the last one written before the checkpoint
+            elements = iter_offset_elements(file_in, offset=state['offset'])
+            first = next(elements, None)
+            if first is None or first[1].attrib.get('id') != state['last_id']:
+                raise ValueError("checkpoint %s does not match the input file" % checkpoint_path)
+            done, last_id, last_offset = state['elements'], state['last_id'], state['offset']
+
+        def flush_batch(batch):
+            if quarantine and validate is True:
+                batch = _quarantine_invalid(batch, rejects)
+                _write_batch(batch, writers, False, stats_or_null)
+            else:
+                _write_batch(batch, writers, validate, stats_or_null)
+
+        def checkpoint():
+            for output in outputs:
+                output.flush()
+            save_checkpoint(checkpoint_path, {
+                'input': os.path.abspath(file_in),
+                'input_size': os.path.getsize(file_in),
+                'elements': done,
+                'last_id': last_id,
+                'offset': last_offset,
+                'outputs': {path: output.tell() for path, output in zip(OUTPUT_PATHS, outputs)},
+                'rejects': outputs[5].tell(),
+            })
+
+        batch = []
+        since_checkpoint = 0
+        with stats_or_null.instrument_correctors(CORRECTORS):
+            for last_offset, element in stats_or_null.timed_iter(elements, 'parse'):
+                done += 1
+                since_checkpoint += 1
+                last_id = element.attrib['id']
+                try:
+                    with stats_or_null.stage('shape'):
+                        el = shape_element(element)
+                except KeyError as error:
+                    if not quarantine:
+                        raise
+                    rejects.reject('shape', 'no correction for %s' % error, element.tag, last_id,
+                                   ET.tostring(element, encoding='unicode'))
+                else:
+                    batch.append(el)
+
+                if len(batch) >= VALIDATION_BATCH:
+                    flush_batch(batch)
+                    batch = []
+                if checkpoint_path is not None and since_checkpoint >= checkpoint_every:
+                    flush_batch(batch)
+                    batch = []
+                    checkpoint()
+                    since_checkpoint = 0
+            flush_batch(batch)
+    finally:
+        for output in outputs:
+            output.close()
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    stats_or_null.finish(OUTPUT_PATHS)
+    return rejects.count
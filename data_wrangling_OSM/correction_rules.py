@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative correction rules for the secondary tag values.
+
+The rules are loaded from correction_rules.json, one rule set per tag key.
+A rule set extracts a token from the value (the street type, the non numeric
+part of a postal code, ...) and looks it up once: first in the expected
+values left untouched, then in the explicit rules of the json file, then in
+the mapping table of the audit module. The expected values and the mapping
+tables are looked up when a value is corrected, so editing mapping_street,
+mapping_city or mapping_postal_code in place applies to the next values
+corrected (create_RDBMS.reload_correctors also drops the cached results).
+
+Operations:
+    set      replace the whole value
+    replace  replace every occurrence of a substring
+    prefix   prepend a text
+    sub      regex substitution, optionally limited to count occurrences
+    map      replace the token with its entry in the mapping table
+"""
+
+import importlib
+import json
+import os
+import re
+
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'correction_rules.json')
+
+
+def _resolve(name):
+    """Return the object referenced by a 'module.attribute' name"""
+    module_name, attribute = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def _compile_op(op):
+    """Compile an operation into a function f(value, start, end, mapped) -> value"""
+    kind = op['op']
+    if kind == 'set':
+        new_value = op['value']
+        return lambda value, start, end, mapped: new_value
+    if kind == 'replace':
+        old, new = op['old'], op['new']
+        return lambda value, start, end, mapped: value.replace(old, new)
+    if kind == 'prefix':
+        text = op['text']
+        return lambda value, start, end, mapped: text + value
+    if kind == 'sub':
+        pattern = re.compile(op['pattern'])
+        repl, count = op['repl'], op.get('count', 0)
+        return lambda value, start, end, mapped: pattern.sub(repl, value, count=count)
+    if kind == 'map':
+        return lambda value, start, end, mapped: value[:start] + mapped() + value[end:]
+    raise ValueError("unknown operation: %s" % kind)
+
+
+class RuleSet(object):
+    """
+    Compiled correction rules of one tag key, called as rule_set(value).
+    Args:
+                token (dict): {'match': pattern} or {'search': pattern} extracting
+                              the token, None to use the whole value
+                rules (dict): token -> tuple of compiled operations
+                strict (bool): raise KeyError for tokens without rules
+                mapping (dict): token -> replacement, looked up at each call
+                mapping_ops (tuple): compiled operations of the mapped tokens
+                keep (list): tokens left untouched, looked up at each call
+    """
+
+    def __init__(self, token, rules, strict=False, mapping=None, mapping_ops=(), keep=()):
+        self.rules = rules
+        self.strict = strict
+        self.mapping = mapping if mapping is not None else {}
+        self.mapping_ops = mapping_ops
+        self.keep = keep
+        self.find = None
+        if token is not None:
+            method = 'match' if 'match' in token else 'search'
+            self.find = getattr(re.compile(token[method]), method)
+
+    def __call__(self, value, mapping=None):
+        """Correct a value, with another mapping table than the rule set's if given"""
+        if mapping is None:
+            mapping = self.mapping
+        if self.find is None:
+            token, start, end = value, 0, len(value)
+        else:
+            m = self.find(value)
+            if m is None:
+                return value
+            token, start, end = m.group(), m.start(), m.end()
+
+        # expected values are left untouched whatever the other rules say
+        if token in self.keep:
+            return value
+        ops = self.rules.get(token)
+        if ops is None:
+            if token not in mapping:
+                if self.strict:
+                    raise KeyError(token)
+                return value
+            ops = self.mapping_ops
+
+        def mapped():
+            return mapping[token]
+
+        for op in ops:
+            value = op(value, start, end, mapped)
+        return value
+
+
+def compile_rule_set(spec):
+    """
+    Compile the json specification of a rule set.
+    Args:
+                spec (dict): rule set specification
+    Returns:
+                callable: corrector(value) of the tag key
+    """
+    if 'function' in spec:
+        return _resolve(spec['function'])
+
+    return RuleSet(spec.get('token'),
+                   {token: tuple(_compile_op(op) for op in ops)
+                    for token, ops in spec.get('rules', {}).items()},
+                   spec.get('strict', False),
+                   _resolve(spec['mapping']) if 'mapping' in spec else None,
+                   tuple(_compile_op(op) for op in spec.get('mapping_ops', ())),
+                   _resolve(spec['keep']) if 'keep' in spec else ())
+
+
+def load_rules(path=RULES_PATH):
+    """
+    Load and compile the correction rules.
+    Args:
+                path (str): json file with one rule set per tag key
+    Returns:
+                dict: tag key -> corrector(value)
+    """
+    mtime = os.stat(path).st_mtime_ns
+    rules = {key: compile_rule_set(spec) for key, spec in load_specs(path).items()}
+    # the correct_* functions of the audits follow the rules last loaded
+    _RULE_SETS[path] = (mtime, rules)
+    return rules
+
+
+def load_specs(path=RULES_PATH):
+    """Return the json specification of the rule sets, keyed by tag key"""
+    with open(path, encoding='utf8') as rules_file:
+        return json.load(rules_file)
+
+
+# path -> (modification time, compiled rules) of rule_set
+_RULE_SETS = {}
+
+
+def refresh_rule_sets(path=RULES_PATH):
+    """Compile the rules of rule_set again if the json file changed since they
+    were loaded. Called once per process_map (through load_rules) and per
+    audit run rather than for each corrected value."""
+    cached = _RULE_SETS.get(path)
+    if cached is None or cached[0] != os.stat(path).st_mtime_ns:
+        load_rules(path)
+
+
+def rule_set(key, path=RULES_PATH):
+    """
+    Return the compiled corrector of a tag key, as last loaded by load_rules
+    or refresh_rule_sets. Used by the correct_* functions of the audit
+    modules, so they apply the same rules as process_map.
+    """
+    if path not in _RULE_SETS:
+        load_rules(path)
+    return _RULE_SETS[path][1][key]
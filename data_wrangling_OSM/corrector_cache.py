@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded cache around the tag value correctors.
+
+Real OSM data repeats the same few thousand street names, postal codes and
+phone numbers over and over, so the result of a corrector is cached keyed on
+the raw value and on the identity of the mapping table it was called with.
+Mutating a mapping table in place does not invalidate the cache, call
+cache_clear (or create_RDBMS.reload_correctors, which process_map calls at
+the start of each run) after doing so.
+"""
+
+from collections import OrderedDict, namedtuple
+
+
+CACHE_SIZE = 65536
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class CachedCorrector(object):
+    """
+    Wrap a corrector function corrector(value[, mapping]) with a bounded cache.
+    Args:
+                corrector (callable): correction function
+                maxsize (int): maximum number of cached values, None for no bound
+                policy (str): eviction policy, 'lru' (least recently used) or
+                              'fifo' (oldest inserted)
+    """
+
+    def __init__(self, corrector, maxsize=CACHE_SIZE, policy='lru'):
+        if policy not in ('lru', 'fifo'):
+            raise ValueError("unknown eviction policy: %s" % policy)
+        self.corrector = corrector
+        self.maxsize = maxsize
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        # keep the mapping tables alive so their id is not reused
+        self._mappings = {}
+
+    def __call__(self, value, *mapping):
+        key = (value, id(mapping[0])) if mapping else (value, None)
+        try:
+            result = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            if self.policy == 'lru':
+                self._cache.move_to_end(key)
+            return result
+
+        self.misses += 1
+        result = self.corrector(value, *mapping)
+        if mapping:
+            self._mappings[id(mapping[0])] = mapping[0]
+        self._cache[key] = result
+        if self.maxsize is not None and len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return result
+
+    def cache_info(self):
+        """Return the hit/miss statistics of the cache"""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        """Empty the cache and reset the statistics"""
+        self._cache.clear()
+        self._mappings.clear()
+        self.hits = 0
+        self.misses = 0
@@ -136,19 +136,17 @@ The final return value for a "way" element should look something like:
 import csv
 import codecs
 import re
+from contextlib import ExitStack
 import xml.etree.cElementTree as ET
 
-import cerberus
-
-import schema
+from validation import validate_elements
+from instrumentation import NULL_STATS
+from osm_stream import open_osm, is_compressed
 
 
     
-from audit_street import audit_street, correct_street_name, mapping_street
-from audit_province import correct_province
-from audit_phone_number import correct_phone_num
-from audit_suburb import audit_city, mapping_city, correct_city_sub
-from audit_postal import audit_postcode, correct_postal_code, mapping_postal_code
+from corrector_cache import CachedCorrector, CACHE_SIZE
+from correction_rules import load_rules
     
     
 NODES_PATH = "nodes.csv"
@@ -156,13 +154,18 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+OUTPUT_PATHS = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH]
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
+RELATION_OUTPUT_PATHS = [RELATIONS_PATH, RELATION_MEMBERS_PATH, RELATION_TAGS_PATH]
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 PHONENUM = re.compile(r'\+1\s\d{3}\s\d{3}\s\d{4}')
 POSTCODE = re.compile(r'[A-z]\d[A-z]\s?\d[A-z]\d')
 
-SCHEMA = schema.schema
+VALIDATION_BATCH = 1000
 
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
@@ -170,65 +173,135 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'member_type', 'member_id', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+
+# members of a relation shaped at once, larger relations are emitted in chunks
+RELATION_CHUNK = 1000
+
+# Dispatch table of the cached correctors used by analyze_subtag, keyed by tag key
+CORRECTORS = {key: CachedCorrector(corrector) for key, corrector in load_rules().items()}
+
+
+def configure_correctors(maxsize=CACHE_SIZE, policy='lru'):
+    """Replace the corrector caches with empty caches of the given size and policy"""
+    for key, cached in CORRECTORS.items():
+        CORRECTORS[key] = CachedCorrector(cached.corrector, maxsize, policy)
+
+
+def reload_correctors():
+    """
+    Compile the correction rules again and empty the corrector caches, so
+    edits of correction_rules.json, of the mapping tables and of the
+    correction functions apply. Called at the start of each process_map.
+    """
+    rules = load_rules()
+    for key in list(CORRECTORS):
+        if key not in rules:
+            del CORRECTORS[key]
+    for key, corrector in rules.items():
+        cached = CORRECTORS.get(key)
+        if cached is None:
+            CORRECTORS[key] = CachedCorrector(corrector)
+        else:
+            CORRECTORS[key] = CachedCorrector(corrector, cached.maxsize, cached.policy)
 
 
+def corrector_cache_info():
+    """Return the hit/miss statistics of each corrector cache"""
+    return {key: cached.cache_info() for key, cached in CORRECTORS.items()}
 
 
-# function to analyze secondary tags. This analysis is the same for node and way (primary) tags
-def analyze_subtag(element, second_tag):
-    
+
+
+# function to split and correct a secondary tag from its "k" and "v" attributes.
+# This is shared by every parser backend and by the compact records
+def split_tag(k, v):
+
+    # check is column is present
+    if ":" not in k:
+
+        # no column
+        key = k
+        tag_type = 'regular'
+    else:
+
+        # column found
+        column_separator_position = k.index(':')
+        key = k[(column_separator_position+1):]
+        tag_type = k[:column_separator_position]
+
+    ### Find and correct problems in the values of the OSM map data
+    # street, postal code, suburb, phone and province correctors are
+    # looked up by key, see correction_rules.json
+    corrector = CORRECTORS.get(key)
+    if corrector is not None:
+        v = corrector(v)
+
+        # phone numbers that cannot be corrected are dropped
+        if v is None:
+            return None
+
+    return key, v, tag_type
+
+
+# function to shape a secondary tag from its parent id, "k" and "v" attributes
+def shape_tag(element_id, k, v):
+
+    tag = split_tag(k, v)
+    if tag is None:
+        return None
 
     # create dictionary for the secondary tag
-    dict_second_tag = {}
-    
-    # if a secondary tag is present, it is parsed
-    if second_tag is not None:
-        dict_second_tag['id'] = element.attrib['id']
+    return {'id': element_id, 'key': tag[0], 'value': tag[1], 'type': tag[2]}
 
-        # check is column is present
-        if ":" not in second_tag.attrib['k']:
 
-            # no column
-            dict_second_tag['key'] = second_tag.attrib['k']
-            dict_second_tag['value'] = second_tag.attrib['v']
-            dict_second_tag['type'] = 'regular'
-        else:
+# function to analyze secondary tags. This analysis is the same for node and way (primary) tags
+def analyze_subtag(element, second_tag):
 
-            # column found
-            column_separator_position = second_tag.attrib['k'].index(':')
-            dict_second_tag['key'] = second_tag.attrib['k'][(column_separator_position+1):]
-            dict_second_tag['type'] = second_tag.attrib['k'][:column_separator_position]
+    # if a secondary tag is present, it is parsed
+    if second_tag is None:
+        return {}
 
-            
-        ### Find and correct problems in the values of the OSM map data        
-        # correct street name
-        if dict_second_tag['key'] == "street":
-            dict_second_tag['value'] = correct_street_name(second_tag.attrib['v'],mapping_street)
+    return shape_tag(element.attrib['id'], second_tag.attrib['k'], second_tag.attrib['v'])
     
-        # correct postal code
-        elif dict_second_tag['key'] == 'postcode':
-            dict_second_tag['value'] = correct_postal_code(second_tag.attrib['v'], mapping_postal_code)
-            
-        # correct suburb name
-        elif dict_second_tag['key'] == 'city':
-            dict_second_tag['value'] = correct_city_sub(second_tag.attrib['v'],mapping_city)
-    
-        # correct phone number
-        elif dict_second_tag['key'] == 'phone':
-            dict_second_tag['value'] = correct_phone_num(second_tag.attrib['v'])
-            if dict_second_tag['value'] is None:
-                return None
-            
-    
-        # correct province 
-        elif dict_second_tag['key'] == 'province':
-            dict_second_tag['value'] = correct_province(second_tag.attrib['v'])
 
-        else:
-            dict_second_tag['value'] = second_tag.attrib['v']
+class RelationShaper(object):
+    """
+    Shape a relation from its attributes, members and tags as they are
+    parsed. Members are emitted in chunks of chunk_size rows as shaped
+    elements holding only 'relation_members', so a boundary or route
+    relation with thousands of members is never held in memory at once.
+    The relation row and its tags come last, with finish().
+    """
+
+    def __init__(self, attribs, chunk_size=RELATION_CHUNK):
+        self.attribs = attribs
+        self.chunk_size = chunk_size
+        self.members = []
+        self.tags = []
+        self.position = 0
+
+    def add_member(self, member_type, ref, role):
+        """Add a member, return a chunk of members when one is full, else None"""
+        self.members.append({'id': self.attribs['id'], 'member_type': member_type,
+                             'member_id': ref, 'role': role, 'position': self.position})
+        self.position += 1
+        if self.chunk_size is not None and len(self.members) >= self.chunk_size:
+            chunk, self.members = self.members, []
+            return {'relation_members': chunk}
+        return None
+
+    def add_tag(self, k, v):
+        dict_subtag = shape_tag(self.attribs['id'], k, v)
+        if dict_subtag is not None:
+            self.tags.append(dict_subtag)
+
+    def finish(self):
+        return {'relation': self.attribs, 'relation_members': self.members,
+                'relation_tags': self.tags}
 
-    return dict_second_tag
-    
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
@@ -277,6 +350,16 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                 way_nodes.append(dict_subtag_nd)
   
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+
+    elif element.tag == 'relation':
+        relation = RelationShaper(dict(element.attrib), chunk_size=None)
+        for secondary_tag in element:
+            if secondary_tag.tag == 'member':
+                relation.add_member(secondary_tag.attrib['type'], secondary_tag.attrib['ref'],
+                                    secondary_tag.attrib['role'])
+            elif secondary_tag.tag == 'tag':
+                relation.add_tag(secondary_tag.attrib['k'], secondary_tag.attrib['v'])
+        return relation.finish()
     
     
 
@@ -284,30 +367,24 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
 #               Helper Functions                     #
 # ================================================== #
 def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
-
-
-def validate_element(element, validator, schema=SCHEMA):
-    """Raise ValidationError if element does not match schema"""
-    if validator.validate(element, schema) is not True:
-        print()
-        print(element)
-        field, errors = next(validator.errors.iteritems())
-        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
-        error_strings = (
-            "{0}: {1}".format(k, v if isinstance(v, str) else ", ".join(v))
-            for k, v in errors.items()
-        )
-        raise cerberus.ValidationError(
-            message_string.format(field, "\n".join(error_strings))
-        )
+    """Yield element if it is the right type of tag
+
+    osm_file is a path, possibly of a .gz or .bz2 file, or a binary file object.
+    """
+
+    close = isinstance(osm_file, str)
+    if close:
+        osm_file = open_osm(osm_file)
+    try:
+        context = ET.iterparse(osm_file, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+    finally:
+        if close:
+            osm_file.close()
 
 
 class UnicodeDictWriter(csv.DictWriter, object):
@@ -323,44 +400,347 @@ class UnicodeDictWriter(csv.DictWriter, object):
             self.writerow(row)
 
 
+class TeeWriter(object):
+    """Forward the rows written to several writers"""
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def writerow(self, row):
+        for writer in self.writers:
+            writer.writerow(row)
+
+    def writerows(self, rows):
+        for writer in self.writers:
+            writer.writerows(rows)
+
+    def flush(self):
+        for writer in self.writers:
+            if hasattr(writer, 'flush'):
+                writer.flush()
+
+
+def open_writers(nodes_file, nodes_tags_file, ways_file, way_nodes_file, way_tags_file,
+                 header=True, way_fields=WAY_FIELDS, relation_files=None):
+    """Create the csv writers of the five output tables, keyed by element field
+
+    relation_files are the files of the relations, relation members and
+    relation tags tables, if relations are written.
+    """
+
+    writers = {
+        'node': UnicodeDictWriter(nodes_file, NODE_FIELDS),
+        'node_tags': UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS),
+        'way': UnicodeDictWriter(ways_file, way_fields),
+        'way_nodes': UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS),
+        'way_tags': UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS),
+    }
+    if relation_files is not None:
+        relations_file, relation_members_file, relation_tags_file = relation_files
+        writers['relation'] = UnicodeDictWriter(relations_file, RELATION_FIELDS)
+        writers['relation_members'] = UnicodeDictWriter(relation_members_file,
+                                                        RELATION_MEMBERS_FIELDS)
+        writers['relation_tags'] = UnicodeDictWriter(relation_tags_file, RELATION_TAGS_FIELDS)
+
+    if header:
+        for writer in writers.values():
+            writer.writeheader()
+
+    return writers
+
+
+def _write_shaped(shaped, writers):
+    """Write shaped elements to the writers of their tables"""
+
+    for el in shaped:
+        if 'node' in el:
+            writers['node'].writerow(el['node'])
+            writers['node_tags'].writerows(el['node_tags'])
+        elif 'way' in el:
+            writers['way'].writerow(el['way'])
+            writers['way_nodes'].writerows(el['way_nodes'])
+            writers['way_tags'].writerows(el['way_tags'])
+        else:
+            # relation, or a chunk of the members of a large relation
+            if 'relation' in el:
+                writers['relation'].writerow(el['relation'])
+                writers['relation_tags'].writerows(el['relation_tags'])
+            writers['relation_members'].writerows(el['relation_members'])
+
+
+def _write_batch(batch, writers, validate, stats, transform=None):
+    """Validate, transform and write a batch of shaped elements, timing the stages"""
+
+    if validate is True:
+        with stats.stage('validate'):
+            validate_elements(batch)
+    if transform is not None:
+        with stats.stage('transform'):
+            transform(batch)
+    with stats.stage('write'):
+        _write_shaped(batch, writers)
+    stats.elements_done(batch)
+
+
+def write_shaped(shaped, writers, validate, batch_size=VALIDATION_BATCH, stats=None,
+                 transform=None):
+    """Optionally validate and write each shaped element to the writers
+
+    Shaped elements are validated in batches with the compiled schema checks
+    of validation.validate_elements, before the batch is written. A
+    transform(batch) callable can add columns to the validated batch before
+    it is written. With an instrumentation.PipelineStats the stages are
+    timed and counted.
+    """
+
+    if stats is None:
+        stats = NULL_STATS
+
+    batch = []
+    for el in shaped:
+        if el:
+            batch.append(el)
+            if len(batch) >= batch_size:
+                _write_batch(batch, writers, validate, stats, transform)
+                batch = []
+
+    _write_batch(batch, writers, validate, stats, transform)
+
+
+def write_elements(elements, writers, validate, batch_size=VALIDATION_BATCH):
+    """Shape, optionally validate and write each element to the writers"""
+
+    write_shaped((shape_element(element) for element in elements), writers, validate, batch_size)
+
+
+def iter_shaped_etree(file_in, tags=('node', 'way'), stats=None, shape=shape_element,
+                      element_filter=None):
+    """Yield the shaped elements of an OSM file parsed with ElementTree
+
+    Nodes and ways are shaped with shape(element) once fully parsed, if they
+    pass element_filter. The members and tags of relations are shaped and
+    dropped from the tree as they are parsed, see RelationShaper.
+    """
+
+    if 'relation' not in tags:
+        elements = get_element(file_in, tags)
+        if element_filter is not None:
+            element_filter = element_filter.start()
+            elements = (element for element in elements if element_filter.accept_element(element))
+        if stats is None:
+            for element in elements:
+                yield shape(element)
+            return
+
+        for element in stats.timed_iter(elements, 'parse'):
+            with stats.stage('shape'):
+                el = shape(element)
+            yield el
+        return
+
+    if stats is None:
+        stats = NULL_STATS
+    osm_file = open_osm(file_in) if isinstance(file_in, str) else file_in
+    try:
+        context = stats.timed_iter(ET.iterparse(osm_file, events=('start', 'end')), 'parse')
+        _, root = next(context)
+        relation = relation_element = None
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag == 'relation':
+                    relation = RelationShaper(dict(elem.attrib))
+                    relation_element = elem
+            elif relation is not None:
+                if elem.tag == 'member':
+                    with stats.stage('shape'):
+                        chunk = relation.add_member(elem.attrib['type'], elem.attrib['ref'],
+                                                    elem.attrib['role'])
+                    relation_element.remove(elem)
+                    if chunk is not None:
+                        yield chunk
+                elif elem.tag == 'tag':
+                    with stats.stage('shape'):
+                        relation.add_tag(elem.attrib['k'], elem.attrib['v'])
+                    relation_element.remove(elem)
+                elif elem.tag == 'relation':
+                    yield relation.finish()
+                    relation = relation_element = None
+                    root.clear()
+            elif elem.tag in tags:
+                with stats.stage('shape'):
+                    el = shape(elem)
+                yield el
+                root.clear()
+    finally:
+        if osm_file is not file_in:
+            osm_file.close()
+
+
+def iter_shaped(file_in, backend='etree', tags=('node', 'way'), stats=None, workers=1,
+                element_filter=None):
+    """Yield the shaped elements of an OSM file parsed with the given backend
+
+    .osm.pbf files are always read with the 'pbf' backend, which decodes the
+    blocks with workers processes. With an element_filter only the elements
+    passing it are shaped, see element_filter. With an
+    instrumentation.PipelineStats the etree backend times the 'parse' and
+    'shape' stages apart, the other backends shape the elements as they are
+    parsed and are timed as one 'parse_shape' stage.
+    """
+
+    if backend == 'pbf' or (isinstance(file_in, str) and file_in.endswith('.pbf')):
+        from pbf_backend import iter_shaped_pbf
+        shaped = iter_shaped_pbf(file_in, tags, workers, element_filter=element_filter)
+        return (stats or NULL_STATS).timed_iter(shaped, 'parse_shape')
+    if backend == 'expat':
+        from expat_backend import iter_shaped_expat
+        shaped = iter_shaped_expat(file_in, tags, element_filter=element_filter)
+        return (stats or NULL_STATS).timed_iter(shaped, 'parse_shape')
+    if backend == 'etree':
+        return iter_shaped_etree(file_in, tags, stats, element_filter=element_filter)
+    raise ValueError("unknown parser backend: %s" % backend)
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
+def process_map(file_in, validate, workers=1, db_path=None, backend='etree', stats=None,
+                node_store=None, way_geometry=False, node_index_path=None, checkpoint=None,
+                quarantine=False, relations=False, element_filter=None, checkpoint_every=None,
+                encode=False):
+    """Iteratively process each XML element and write to csv(s)
+
+    With workers > 1 the file is split in chunks processed by a pool of
+    processes, see parallel_map.process_map_parallel. With a db_path the
+    elements are loaded straight into that SQLite database instead of the
+    csv(s), see load_db.process_map_db. backend selects the XML parser,
+    'etree' (ElementTree iterparse) or 'expat' (see expat_backend). An
+    instrumentation.PipelineStats passed as stats collects per-stage timings
+    and counters, reports progress and writes a json summary at the end.
+    With a node_store directory the nodes are also written to a memory-mapped
+    columnar store, see node_store. With way_geometry the bounding box,
+    length and centroid of each way are added to the ways table, resolved
+    from a node location index kept in memory, or on disk in node_index_path
+    if given, see node_index. .osm.pbf files are read with the 'pbf' backend
+    (see pbf_backend), whose blocks are decoded by workers processes for any
+    output. .gz and .bz2 files are decompressed on the fly (see
+    osm_stream.open_osm) and processed serially, since the parallel path
+    needs to seek in the file. With a checkpoint path the csv run saves
+    checkpoints it resumes from when rerun, and with quarantine the elements
+    failing correction or validation go to a reject file instead of aborting
+    the run, see checkpoint.process_map_resumable; checkpoint_every sets the
+    number of elements between two checkpoints. With relations the
+    relations, their members and their tags are written too, to the
+    RELATION_OUTPUT_PATHS csv(s) or the relation tables, streaming the
+    members of large relations in chunks (see RelationShaper). With an
+    element_filter only the nodes and ways passing it are processed, see
+    element_filter.ElementFilter. With encode the tag tables of the
+    database are dictionary encoded after the load, see tag_dictionary.
+    """
+
+    reload_correctors()
+    if is_compressed(file_in):
+        workers = 1
+    pbf = backend == 'pbf' or file_in.endswith('.pbf')
+
+    if relations and ((workers > 1 and not pbf) or checkpoint is not None or quarantine):
+        raise ValueError("relations are not supported with workers > 1, checkpoint or quarantine")
+    if element_filter is not None and (relations or (workers > 1 and not pbf)
+                                       or checkpoint is not None or quarantine):
+        raise ValueError("element_filter is not supported with relations, workers > 1, "
+                         "checkpoint or quarantine")
+
+    if encode and db_path is None:
+        raise ValueError("encode is only supported with a db_path")
+
+    if checkpoint is not None or quarantine:
+        if (workers > 1 or db_path is not None or backend != 'etree' or node_store is not None
+                or way_geometry):
+            raise ValueError("checkpoint and quarantine are only supported for serial csv "
+                             "output with the etree backend")
+        from checkpoint import process_map_resumable
+        return process_map_resumable(file_in, validate, checkpoint, checkpoint_every, quarantine,
+                                     stats=stats)
+
+    if workers > 1 and not pbf and (db_path is not None or node_store is not None or way_geometry):
+        raise ValueError("workers > 1 is only supported for csv output")
+
+    if db_path is not None:
+        from load_db import process_map_db
+        return process_map_db(file_in, validate, db_path, backend=backend, stats=stats,
+                              node_store=node_store, way_geometry=way_geometry,
+                              node_index_path=node_index_path, workers=workers,
+                              relations=relations, element_filter=element_filter, encode=encode)
+
+    if workers > 1 and not pbf:
+        from parallel_map import process_map_parallel
+        return process_map_parallel(file_in, validate, workers, backend=backend, stats=stats)
+
+    stats_or_null = stats if stats is not None else NULL_STATS
+    with stats_or_null.instrument_correctors(CORRECTORS):
+        _process_map_csv(file_in, validate, backend, stats, node_store,
+                         way_geometry, node_index_path, workers, relations, element_filter)
+    stats_or_null.finish(OUTPUT_PATHS + (RELATION_OUTPUT_PATHS if relations else []))
+
+
+def add_node_store(writers, node_store):
+    """Also write the nodes to a columnar store, return the store writer"""
+
+    from node_store import NodeStoreWriter
+    store_writer = NodeStoreWriter(node_store)
+    writers['node'] = TeeWriter(writers['node'], store_writer)
+    return store_writer
+
+
+def _process_map_csv(file_in, validate, backend, stats, node_store=None, way_geometry=False,
+                     node_index_path=None, workers=1, relations=False, element_filter=None):
+    """Process each XML element and write to the csv(s)
+
+    Without a node store the parse, transform and write stages run
+    pipelined on their own threads, see pipeline.process_map_pipelined.
+    """
+
+    transform = None
+    way_fields = WAY_FIELDS
+    if way_geometry:
+        from node_index import open_way_geometry, WAY_GEOMETRY_FIELDS
+        transform = open_way_geometry(node_index_path)
+        way_fields = WAY_FIELDS + WAY_GEOMETRY_FIELDS
+    tags = ('node', 'way', 'relation') if relations else ('node', 'way')
+
+    if node_store is None:
+        from pipeline import process_map_pipelined
+        output_paths = OUTPUT_PATHS + (RELATION_OUTPUT_PATHS if relations else [])
+        try:
+            process_map_pipelined(file_in, validate, output_paths, backend, stats, transform,
+                                  way_fields, workers, tags=tags, element_filter=element_filter)
+        finally:
+            if transform is not None:
+                transform.close()
+        return
 
     with codecs.open(NODES_PATH, 'w') as nodes_file, \
          codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
          codecs.open(WAYS_PATH, 'w') as ways_file, \
          codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
-
-
+         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file, \
+         ExitStack() as relation_stack:
+
+        relation_files = None
+        if relations:
+            relation_files = [relation_stack.enter_context(codecs.open(path, 'w'))
+                              for path in RELATION_OUTPUT_PATHS]
+        writers = open_writers(nodes_file, nodes_tags_file, ways_file,
+                               way_nodes_file, way_tags_file, way_fields=way_fields,
+                               relation_files=relation_files)
+        store_writer = add_node_store(writers, node_store) if node_store is not None else None
+
+        try:
+            write_shaped(iter_shaped(file_in, backend, tags, stats=stats, workers=workers,
+                                     element_filter=element_filter),
+                         writers, validate, stats=stats, transform=transform)
+        finally:
+            if transform is not None:
+                transform.close()
+        if store_writer is not None:
+            store_writer.close()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Parse-time filters of the nodes and ways of an OSM file.
+
+An ElementFilter is evaluated on the raw attributes, tags and node
+references of each element as soon as it has been parsed, before any
+shaping, correction or validation, so extracting a subset costs about one
+parse of the file:
+
+    # amenities in the Mestre postal codes
+    process_map(file_in, validate=True,
+                element_filter=ElementFilter(tags={'amenity': None},
+                                             postcode_range=(min_code, max_code)))
+
+All the given criteria must hold. A node is inside the bounding box if its
+coordinates are, a way if any of its nodes is, so the ids of the nodes
+inside the box are kept while the file is parsed (nodes come before ways
+in an OSM file). Each pass over a file evaluates the copy of the filter
+returned by start(), so these ids are dropped with the pass instead of
+accumulating on a filter reused across runs.
+"""
+
+import re
+
+from audit_postal import min_code, max_code
+
+
+POSTCODE_KEY = 'addr:postcode'
+POSTCODE_RE = re.compile(r'\d{5}')
+MESTRE_POSTCODES = (min_code, max_code)
+
+
+class ElementFilter(object):
+    """
+    Predicate over the raw nodes and ways.
+    Args:
+                bbox (tuple): (min_lat, min_lon, max_lat, max_lon) of the area
+                tags (dict): tag key -> required value, None for any value; an
+                             element must have at least one of the tags
+                postcode_range (tuple): (min_code, max_code) of the addr:postcode
+                                        tag, e.g. MESTRE_POSTCODES
+    """
+
+    def __init__(self, bbox=None, tags=None, postcode_range=None):
+        self.bbox = bbox
+        self.tags = tags
+        self.postcode_range = postcode_range
+        self.nodes_inside = set()
+
+    def start(self):
+        """Return a copy of the filter for one pass over a file, with no node
+        inside the bounding box yet"""
+        return ElementFilter(self.bbox, self.tags, self.postcode_range)
+
+    def _match_tags(self, tags):
+        if self.tags is not None:
+            for k, v in tags:
+                if k in self.tags and self.tags[k] in (None, v):
+                    break
+            else:
+                return False
+        if self.postcode_range is not None:
+            for k, v in tags:
+                if k == POSTCODE_KEY:
+                    m = POSTCODE_RE.search(v)
+                    if m is not None and self.postcode_range[0] <= int(m.group()) <= self.postcode_range[1]:
+                        break
+            else:
+                return False
+        return True
+
+    def accept(self, element_type, attribs, tags, refs=()):
+        """
+        Return True if the element passes the filter.
+        Args:
+                element_type (str): 'node' or 'way'
+                attribs (dict): raw attributes of the element
+                tags (list): (key, value) of the raw tags
+                refs (list): node references of a way
+        Returns:
+                bool: True to keep the element
+        """
+        if self.bbox is not None:
+            if element_type == 'node':
+                min_lat, min_lon, max_lat, max_lon = self.bbox
+                if not (min_lat <= float(attribs['lat']) <= max_lat
+                        and min_lon <= float(attribs['lon']) <= max_lon):
+                    return False
+                self.nodes_inside.add(int(attribs['id']))
+            else:
+                nodes_inside = self.nodes_inside
+                if not any(int(ref) in nodes_inside for ref in refs):
+                    return False
+        return self._match_tags(tags)
+
+    def accept_element(self, element):
+        """Return True if a parsed node or way Element passes the filter"""
+        tags = [(child.attrib['k'], child.attrib['v']) for child in element.iter('tag')]
+        refs = [child.attrib['ref'] for child in element.iter('nd')]
+        return self.accept(element.tag, element.attrib, tags, refs)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming expat parser backend.
+
+The expat callbacks build the shaped rows of nodes, node tags, ways, way
+nodes and way tags directly, without building any Element tree. The shaped
+elements are the same as the ones returned by create_RDBMS.shape_element, so
+the backend is a drop-in replacement of the ElementTree one:
+
+    process_map(file_in, validate=True, backend='expat')
+"""
+
+import time
+from xml.parsers import expat
+
+from create_RDBMS import shape_tag, iter_shaped, RelationShaper
+from osm_stream import open_osm
+from records import NodeRecord, WayRecord
+
+
+READ_SIZE = 64 * 1024
+
+
+class ShapedElementBuilder(object):
+    """expat callbacks that shape the top level elements as they are parsed"""
+
+    def __init__(self, tags=('node', 'way')):
+        self.tags = tags
+        self.depth = 0
+        self.current = None
+        self.current_id = None
+        self.relation = None
+        self.shaped = []
+
+    def relation_child(self, name, attrs):
+        if name == 'member':
+            chunk = self.relation.add_member(attrs['type'], attrs['ref'], attrs['role'])
+            if chunk is not None:
+                self.shaped.append(chunk)
+        elif name == 'tag':
+            self.relation.add_tag(attrs['k'], attrs['v'])
+
+    def start_element(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            if name in self.tags:
+                self.current_id = attrs.get('id')
+                if name == 'node':
+                    self.current = {'node': attrs, 'node_tags': []}
+                elif name == 'way':
+                    self.current = {'way': attrs, 'way_nodes': [], 'way_tags': []}
+                elif name == 'relation':
+                    self.relation = RelationShaper(attrs)
+        elif self.relation is not None:
+            self.relation_child(name, attrs)
+        elif self.current is not None:
+            if name == 'tag':
+                dict_subtag = shape_tag(self.current_id, attrs['k'], attrs['v'])
+                if dict_subtag is not None:
+                    tags = self.current.get('node_tags')
+                    if tags is None:
+                        tags = self.current['way_tags']
+                    tags.append(dict_subtag)
+            elif name == 'nd' and 'way_nodes' in self.current:
+                way_nodes = self.current['way_nodes']
+                way_nodes.append({'id': self.current_id, 'node_id': attrs['ref'],
+                                  'position': len(way_nodes)})
+
+    def end_element(self, name):
+        if self.depth == 2:
+            if self.current is not None:
+                self.shaped.append(self.current)
+                self.current = None
+            elif self.relation is not None:
+                self.shaped.append(self.relation.finish())
+                self.relation = None
+        self.depth -= 1
+
+
+class RecordBuilder(ShapedElementBuilder):
+    """expat callbacks that build the compact records of the top level elements"""
+
+    def start_element(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            if name == 'node' and 'node' in self.tags:
+                self.current = NodeRecord(attrs)
+            elif name == 'way' and 'way' in self.tags:
+                self.current = WayRecord(attrs)
+            elif name == 'relation' and 'relation' in self.tags:
+                self.relation = RelationShaper(attrs)
+        elif self.relation is not None:
+            self.relation_child(name, attrs)
+        elif self.current is not None:
+            if name == 'tag':
+                self.current.add_tag(attrs['k'], attrs['v'])
+            elif name == 'nd' and self.current.field == 'way':
+                self.current.add_ref(attrs['ref'])
+
+
+class RawElementBuilder(ShapedElementBuilder):
+    """
+    expat callbacks that collect the raw attributes, tags and node references
+    of the top level elements, shaping only the ones passing a filter
+    """
+
+    def __init__(self, tags, element_filter, shape):
+        super(RawElementBuilder, self).__init__(tags)
+        self.element_filter = element_filter
+        self.shape = shape
+
+    def start_element(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            if name in self.tags:
+                self.current = (name, attrs, [], [])
+        elif self.current is not None:
+            if name == 'tag':
+                self.current[2].append((attrs['k'], attrs['v']))
+            elif name == 'nd':
+                self.current[3].append(attrs['ref'])
+
+    def end_element(self, name):
+        if self.depth == 2 and self.current is not None:
+            if self.element_filter.accept(*self.current):
+                self.shaped.append(self.shape(*self.current))
+            self.current = None
+        self.depth -= 1
+
+
+def iter_shaped_expat(osm_file, tags=('node', 'way'), records=False, element_filter=None):
+    """
+    Yield the shaped elements of an OSM file parsed with expat.
+    Args:
+                osm_file (str or file): OSM file path, possibly .gz or .bz2, or binary
+                                        file object
+                tags (tuple): top level tags to yield, node, way and/or relation
+                records (bool): yield compact records instead, see records
+                element_filter (ElementFilter): only shape the nodes and ways passing
+                                                this filter, see element_filter
+    Yields:
+                dict: shaped element, as returned by shape_element
+    """
+    if element_filter is not None:
+        from pbf_backend import shape_raw, record_raw
+        builder = RawElementBuilder(tags, element_filter.start(), record_raw if records else shape_raw)
+    elif records:
+        builder = RecordBuilder(tags)
+    else:
+        builder = ShapedElementBuilder(tags)
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = builder.start_element
+    parser.EndElementHandler = builder.end_element
+
+    close = False
+    if isinstance(osm_file, str):
+        osm_file = open_osm(osm_file)
+        close = True
+    try:
+        while True:
+            data = osm_file.read(READ_SIZE)
+            parser.Parse(data, not data)
+            if builder.shaped:
+                shaped, builder.shaped = builder.shaped, []
+                for element in shaped:
+                    yield element
+            if not data:
+                break
+    finally:
+        if close:
+            osm_file.close()
+
+
+def benchmark_backends(file_in, backends=('etree', 'expat')):
+    """
+    Time the parse and shape of an OSM file with each backend.
+    Args:
+                file_in (str): OSM file path
+                backends (tuple): backends to compare
+    Returns:
+                dict: backend -> (elements, seconds, elements per second)
+    """
+    results = {}
+    for backend in backends:
+        start = time.perf_counter()
+        count = 0
+        for el in iter_shaped(file_in, backend):
+            if el:
+                count += 1
+        elapsed = time.perf_counter() - start
+        results[backend] = (count, elapsed, count / elapsed if elapsed else float('inf'))
+    return results
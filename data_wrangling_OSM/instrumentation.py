@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage instrumentation of process_map.
+
+A PipelineStats passed to process_map(..., stats=stats) collects:
+    - the time spent in each stage: 'parse' and 'shape' for the etree
+      backend, a single 'parse_shape' for the expat and pbf backends, which
+      shape the elements from the parser callbacks, 'correct' (the tag
+      correctors, part of the shape or parse_shape time), 'validate',
+      'transform' and 'write'; the pipelined run splits the writing into
+      'rows' (records to csv rows) and 'write_<table>' per csv, loading a
+      database adds 'index'
+    - elements, tags, way nodes and relation members processed
+    - calls, time and dropped values (corrector returned None) per corrector
+    - bytes written per output
+Progress is reported every progress_every elements and a json summary is
+written at the end of the run when summary_path is given.
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+PROGRESS_EVERY = 100000
+# element and row counters of the summary
+COUNTERS = ('elements', 'nodes', 'node_tags', 'ways', 'way_tags', 'way_nodes',
+            'relations', 'relation_tags', 'relation_members')
+
+
+def print_progress(stats):
+    """Default progress reporter"""
+    summary = stats.summary()
+    print('%d elements, %.0f elements/s, %.1f s' % (
+        summary['elements'], summary['elements_per_sec'], summary['elapsed']))
+
+
+class TimedCorrector(object):
+    """Wrap a corrector to count its calls, time and dropped values, adding
+    its time to the 'correct' stage of timings"""
+
+    def __init__(self, corrector, counters, timings):
+        self.corrector = corrector
+        self.counters = counters
+        self.timings = timings
+        for name in ('calls', 'dropped', 'seconds'):
+            counters[name] += 0
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        result = self.corrector(*args)
+        elapsed = time.perf_counter() - start
+        self.counters['seconds'] += elapsed
+        self.timings['correct'] += elapsed
+        self.counters['calls'] += 1
+        if result is None:
+            self.counters['dropped'] += 1
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.corrector, name)
+
+
+@contextmanager
+def _no_stage():
+    yield
+
+
+class NullStats(object):
+    """Stand-in for PipelineStats when a run is not instrumented"""
+
+    def stage(self, name):
+        return _no_stage()
+
+    def timed_iter(self, iterable, name):
+        return iterable
+
+    def instrument_correctors(self, correctors):
+        return _no_stage()
+
+    def elements_done(self, shaped):
+        pass
+
+    def finish(self, output_paths=()):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+class PipelineStats(object):
+    """
+    Timings and counters of a process_map run.
+    Args:
+                progress_every (int): report progress every this many elements, 0 to disable
+                report (callable): report(stats) called to report progress
+                summary_path (str): json file the summary is written to at the end
+    """
+
+    def __init__(self, progress_every=PROGRESS_EVERY, report=print_progress, summary_path=None):
+        self.progress_every = progress_every
+        self.report = report
+        self.summary_path = summary_path
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.correctors = defaultdict(lambda: defaultdict(int))
+        self.bytes_written = {}
+        self.started = time.perf_counter()
+        self.finished = None
+        self._next_report = progress_every
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of code as part of a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def timed_iter(self, iterable, name):
+        """Yield the items of an iterable, timing each step as part of a stage"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.timings[name] += time.perf_counter() - start
+                return
+            self.timings[name] += time.perf_counter() - start
+            yield item
+
+    @contextmanager
+    def instrument_correctors(self, correctors):
+        """Wrap the correctors of a dispatch table for the duration of a block"""
+        saved = dict(correctors)
+        for key, corrector in saved.items():
+            correctors[key] = TimedCorrector(corrector, self.correctors[key], self.timings)
+        try:
+            yield
+        finally:
+            correctors.update(saved)
+
+    def elements_done(self, shaped):
+        """Count a batch of shaped elements or records and report progress if due"""
+        for el in shaped:
+            if not isinstance(el, dict):
+                # compact record, see records
+                for name, count in el.row_counts():
+                    self.counters[name] += count
+            elif 'node' in el:
+                self.counters['nodes'] += 1
+                self.counters['node_tags'] += len(el['node_tags'])
+            elif 'way' in el:
+                self.counters['ways'] += 1
+                self.counters['way_tags'] += len(el['way_tags'])
+                self.counters['way_nodes'] += len(el['way_nodes'])
+            else:
+                # relation, or a chunk of the members of a large relation
+                if 'relation' in el:
+                    self.counters['relations'] += 1
+                    self.counters['relation_tags'] += len(el['relation_tags'])
+                self.counters['relation_members'] += len(el['relation_members'])
+        self.counters['elements'] += len(shaped)
+
+        if self.progress_every and self.counters['elements'] >= self._next_report:
+            self._next_report = self.counters['elements'] + self.progress_every
+            self.report(self)
+
+    def finish(self, output_paths=()):
+        """Record the size of the outputs and write the json summary"""
+        self.finished = time.perf_counter()
+        for path in output_paths:
+            if os.path.exists(path):
+                self.bytes_written[path] = os.path.getsize(path)
+        if self.summary_path is not None:
+            with open(self.summary_path, 'w') as summary_file:
+                json.dump(self.summary(), summary_file, indent=2, sort_keys=True)
+
+    def merge(self, summary):
+        """Add the summary of another run, e.g. of a worker process"""
+        for name, seconds in summary['stages'].items():
+            self.timings[name] += seconds
+        for name in COUNTERS:
+            self.counters[name] += summary.get(name, 0)
+        for key, counters in summary['correctors'].items():
+            for name, value in counters.items():
+                self.correctors[key][name] += value
+
+    def summary(self):
+        """Return the timings and counters as a json serializable dict"""
+        end = self.finished if self.finished is not None else time.perf_counter()
+        elapsed = end - self.started
+        summary = {
+            'elapsed': elapsed,
+            'elements_per_sec': self.counters['elements'] / elapsed if elapsed else 0.0,
+            'stages': dict(self.timings),
+            'correctors': {key: dict(counters) for key, counters in self.correctors.items()},
+            'bytes_written': dict(self.bytes_written),
+        }
+        for name in COUNTERS:
+            summary[name] = self.counters[name]
+        return summary
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Load the shaped OSM elements straight into SQLite, without going through the
+csv files.
+
+SQLiteTableWriter has the same writerow/writerows interface as the csv
+writers of create_RDBMS, so the shape/validate/write loop is shared. Rows are
+buffered and inserted with executemany inside a single transaction, the
+journal and the fsyncs are switched off during the load and the indexes are
+only built once all the rows are in.
+"""
+
+import sqlite3
+
+from node_index import open_way_geometry, WAY_GEOMETRY_FIELDS
+from aggregates import AggregateCollector
+from tag_dictionary import is_encoded, encode_tags
+
+from instrumentation import NULL_STATS
+
+from create_RDBMS import (iter_shaped, write_shaped, add_node_store, reload_correctors, CORRECTORS,
+                          NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS, RELATION_FIELDS,
+                          RELATION_MEMBERS_FIELDS, RELATION_TAGS_FIELDS)
+
+
+DB_PATH = "mestre.db"
+BATCH_SIZE = 50000
+
+# table name and column order of each shaped element field
+TABLES = {
+    'node': ('nodes', NODE_FIELDS),
+    'node_tags': ('nodes_tags', NODE_TAGS_FIELDS),
+    'way': ('ways', WAY_FIELDS),
+    'way_nodes': ('ways_nodes', WAY_NODES_FIELDS),
+    'way_tags': ('ways_tags', WAY_TAGS_FIELDS),
+    'relation': ('relations', RELATION_FIELDS),
+    'relation_members': ('relations_members', RELATION_MEMBERS_FIELDS),
+    'relation_tags': ('relations_tags', RELATION_TAGS_FIELDS),
+}
+
+SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS nodes_tags (
+    id INTEGER,
+    key TEXT,
+    value TEXT,
+    type TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS relations (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS relations_members (
+    id INTEGER NOT NULL,
+    member_type TEXT NOT NULL,
+    member_id INTEGER NOT NULL,
+    role TEXT,
+    position INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS relations_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT
+);
+"""
+
+SQL_TAG_INDEXES = """
+CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags (id);
+CREATE INDEX IF NOT EXISTS nodes_tags_key ON nodes_tags (key);
+CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags (id);
+CREATE INDEX IF NOT EXISTS ways_tags_key ON ways_tags (key);
+"""
+
+SQL_INDEXES = """
+CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes (id, position);
+CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id);
+CREATE INDEX IF NOT EXISTS relations_members_id ON relations_members (id, position);
+CREATE INDEX IF NOT EXISTS relations_members_member ON relations_members (member_type, member_id);
+CREATE INDEX IF NOT EXISTS relations_tags_id ON relations_tags (id);
+CREATE INDEX IF NOT EXISTS relations_tags_key ON relations_tags (key);
+"""
+
+
+class SQLiteTableWriter(object):
+    """Buffer shaped rows and insert them in batches into a SQLite table"""
+
+    def __init__(self, conn, table, fields, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.fields = fields
+        self.batch_size = batch_size
+        self.rows = []
+        self.sql = "INSERT INTO {0} ({1}) VALUES ({2})".format(
+            table, ", ".join('"%s"' % f for f in fields), ", ".join("?" * len(fields)))
+
+    def writerow(self, row):
+        # attributes missing from an element, e.g. the user of an anonymous edit, are NULL
+        self.rows.append(tuple(row.get(f) for f in self.fields))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if self.rows:
+            self.conn.executemany(self.sql, self.rows)
+            self.rows = []
+
+
+def open_db_writers(conn, batch_size=BATCH_SIZE):
+    """Create the SQLite writers of the output tables, keyed by element field"""
+    return {field: SQLiteTableWriter(conn, table, fields, batch_size)
+            for field, (table, fields) in TABLES.items()}
+
+
+def create_tables(conn):
+    """Create the tables of the OSM database if they do not exist"""
+    conn.executescript(SQL_SCHEMA)
+
+
+def create_spatial_index(conn):
+    """Build the R*Tree index over the node coordinates"""
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree "
+                 "USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    conn.execute("DELETE FROM nodes_rtree")
+    conn.execute("INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes")
+
+
+def add_geometry_columns(conn):
+    """Add the way geometry columns to the ways table if they are missing"""
+    columns = set(row[1] for row in conn.execute("PRAGMA table_info(ways)"))
+    for field in WAY_GEOMETRY_FIELDS:
+        if field not in columns:
+            conn.execute("ALTER TABLE ways ADD COLUMN %s REAL" % field)
+
+
+def create_indexes(conn):
+    """Create the secondary indexes of the OSM database"""
+    conn.executescript(SQL_INDEXES)
+    # the encoded tag tables have their own covering indexes
+    if not is_encoded(conn):
+        conn.executescript(SQL_TAG_INDEXES)
+
+
+def begin_bulk_load(conn, existing=False):
+    """
+    Switch off journal and fsyncs for the duration of a bulk load.
+    Args:
+                conn: connection to the OSM database
+                existing (bool): the database already had tables before the load;
+                                 it keeps an in-memory rollback journal, since a
+                                 rollback without journal can corrupt the data
+                                 already in the file
+    """
+    conn.execute("PRAGMA journal_mode = %s" % ("MEMORY" if existing else "OFF"))
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+def end_bulk_load(conn):
+    """Restore the default journal and sync settings after a bulk load"""
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.execute("PRAGMA synchronous = FULL")
+
+
+def process_map_db(file_in, validate, db_path=DB_PATH, batch_size=BATCH_SIZE, backend='etree',
+                   stats=None, node_store=None, way_geometry=False, node_index_path=None,
+                   spatial_index=True, encode=False, aggregates=True, workers=1,
+                   relations=False, element_filter=None):
+    """
+    Iteratively process each XML element and load it into a SQLite database.
+    Args:
+                file_in (str): OSM file path
+                validate (bool): validate the shaped elements against the schema
+                db_path (str): path of the SQLite database
+                batch_size (int): number of rows inserted by each executemany
+                backend (str): parser backend, 'etree', 'expat' or 'pbf'
+                stats (PipelineStats): collects timings and counters of the load
+                node_store (str): directory of a columnar node store also written
+                way_geometry (bool): add bounding box, length and centroid to the ways
+                node_index_path (str): keep the node location index on disk in this file
+                spatial_index (bool): build the R*Tree index over the node coordinates
+                encode (bool): dictionary encode the tag tables and index their values
+                               for full-text search, see tag_dictionary
+                aggregates (bool): count elements, users and tags into the summary
+                                   tables, see aggregates
+                workers (int): processes decoding the blocks of a .osm.pbf file
+                relations (bool): also load the relations, their members and tags
+                element_filter (ElementFilter): only load the nodes and ways passing
+                                                this filter, see element_filter
+    """
+    stats_or_null = stats if stats is not None else NULL_STATS
+    reload_correctors()
+    transforms = []
+    if way_geometry:
+        transforms.append(open_way_geometry(node_index_path))
+    collector = AggregateCollector() if aggregates else None
+    if collector is not None:
+        transforms.append(collector)
+
+    def transform(batch):
+        for step in transforms:
+            step(batch)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        existing = conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is not None
+        create_tables(conn)
+        begin_bulk_load(conn, existing)
+
+        conn.execute("BEGIN")
+        writers = open_db_writers(conn, batch_size)
+        if way_geometry:
+            add_geometry_columns(conn)
+            writers['way'] = SQLiteTableWriter(conn, 'ways', WAY_FIELDS + WAY_GEOMETRY_FIELDS, batch_size)
+        store_writer = add_node_store(writers, node_store) if node_store is not None else None
+        with stats_or_null.instrument_correctors(CORRECTORS):
+            tags = ('node', 'way', 'relation') if relations else ('node', 'way')
+            write_shaped(iter_shaped(file_in, backend, tags, stats=stats, workers=workers,
+                                     element_filter=element_filter),
+                         writers, validate, stats=stats,
+                         transform=transform if transforms else None)
+        with stats_or_null.stage('write'):
+            for writer in writers.values():
+                writer.flush()
+            if store_writer is not None:
+                store_writer.close()
+            if collector is not None:
+                collector.write(conn)
+        conn.execute("COMMIT")
+
+        with stats_or_null.stage('index'):
+            create_indexes(conn)
+            if spatial_index:
+                conn.execute("BEGIN")
+                create_spatial_index(conn)
+                conn.execute("COMMIT")
+            if encode:
+                encode_tags(conn)
+        end_bulk_load(conn)
+    finally:
+        conn.close()
+        for step in transforms:
+            step.close()
+
+    stats_or_null.finish([db_path])
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Node location index and way geometries.
+
+As nodes stream by, their id -> (lat, lon) is stored in a compact index:
+three typed arrays searched with bisect in memory, or a SQLite table on disk
+for extracts bigger than RAM. Ways arrive after the nodes in OSM files, so
+their bounding box, length and centroid are resolved from the index when
+they are written and emitted as extra columns of the ways table.
+"""
+
+import math
+import os
+import sqlite3
+import tempfile
+from array import array
+from bisect import bisect_left
+
+
+WAY_GEOMETRY_FIELDS = ['min_lat', 'min_lon', 'max_lat', 'max_lon', 'length',
+                       'centroid_lat', 'centroid_lon']
+EARTH_RADIUS = 6371008.8
+BATCH_SIZE = 50000
+
+
+class NodeLocationIndex(object):
+    """In-memory id -> (lat, lon) index backed by typed arrays"""
+
+    def __init__(self):
+        self.ids = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.is_sorted = True
+
+    def add(self, node_id, lat, lon):
+        if self.ids and node_id < self.ids[-1]:
+            self.is_sorted = False
+        self.ids.append(node_id)
+        self.lats.append(lat)
+        self.lons.append(lon)
+
+    def _sort(self):
+        order = sorted(range(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array('q', (self.ids[i] for i in order))
+        self.lats = array('d', (self.lats[i] for i in order))
+        self.lons = array('d', (self.lons[i] for i in order))
+        self.is_sorted = True
+
+    def get_many(self, node_ids):
+        """Return the (lat, lon) of each node id, None for unknown ids"""
+        if not self.is_sorted:
+            self._sort()
+        ids, n = self.ids, len(self.ids)
+        locations = []
+        for node_id in node_ids:
+            i = bisect_left(ids, node_id)
+            locations.append((self.lats[i], self.lons[i]) if i < n and ids[i] == node_id else None)
+        return locations
+
+    def close(self):
+        pass
+
+
+class DiskNodeLocationIndex(object):
+    """
+    Disk-backed id -> (lat, lon) index stored in a SQLite table.
+    Args:
+                path (str): database file, a temporary file if None
+    """
+
+    def __init__(self, path=None, batch_size=BATCH_SIZE):
+        self.temporary = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix='node_index_', suffix='.db')
+            os.close(handle)
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = []
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS locations "
+                          "(id INTEGER PRIMARY KEY, lat REAL, lon REAL)")
+
+    def add(self, node_id, lat, lon):
+        self.pending.append((node_id, lat, lon))
+        if len(self.pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.conn.executemany("INSERT OR REPLACE INTO locations VALUES (?, ?, ?)", self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    def get_many(self, node_ids):
+        """Return the (lat, lon) of each node id, None for unknown ids"""
+        self._flush()
+        found = {}
+        unique = list(set(node_ids))
+        # stay below the SQLite limit of bound parameters
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            sql = "SELECT id, lat, lon FROM locations WHERE id IN (%s)" % ",".join("?" * len(chunk))
+            for node_id, lat, lon in self.conn.execute(sql, chunk):
+                found[node_id] = (lat, lon)
+        return [found.get(node_id) for node_id in node_ids]
+
+    def close(self):
+        self.conn.close()
+        if self.temporary:
+            os.remove(self.path)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance in meters between two points"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def way_geometry(locations):
+    """
+    Compute the geometry of a way from the locations of its nodes.
+    Args:
+                locations (list): (lat, lon) of the way nodes in order, None if unknown
+    Returns:
+                dict: bounding box, length in meters and centroid, None values if no
+                      node location is known
+    """
+    points = [p for p in locations if p is not None]
+    if not points:
+        return dict.fromkeys(WAY_GEOMETRY_FIELDS)
+
+    lats = [p[0] for p in points]
+    lons = [p[1] for p in points]
+    length = sum(haversine(a[0], a[1], b[0], b[1]) for a, b in zip(points, points[1:]))
+
+    # the last node of a closed way repeats the first one
+    vertices = points[:-1] if len(points) > 1 and points[0] == points[-1] else points
+    return {
+        'min_lat': min(lats),
+        'min_lon': min(lons),
+        'max_lat': max(lats),
+        'max_lon': max(lons),
+        'length': length,
+        'centroid_lat': sum(p[0] for p in vertices) / len(vertices),
+        'centroid_lon': sum(p[1] for p in vertices) / len(vertices),
+    }
+
+
+class WayGeometryTransform(object):
+    """
+    Batch transform of write_shaped that indexes the node locations and adds
+    the geometry columns to the ways.
+    Args:
+                index: NodeLocationIndex or DiskNodeLocationIndex
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __call__(self, batch):
+        for el in batch:
+            if 'node' in el:
+                node = el['node']
+                self.index.add(int(node['id']), float(node['lat']), float(node['lon']))
+            elif 'way' in el:
+                refs = [int(way_node['node_id']) for way_node in el['way_nodes']]
+                el['way'].update(way_geometry(self.index.get_many(refs)))
+
+    def close(self):
+        self.index.close()
+
+
+def open_way_geometry(node_index_path=None, disk=False):
+    """Return a WayGeometryTransform over a memory or disk node location index"""
+    if disk or node_index_path is not None:
+        return WayGeometryTransform(DiskNodeLocationIndex(node_index_path))
+    return WayGeometryTransform(NodeLocationIndex())
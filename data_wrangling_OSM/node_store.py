@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped columnar store of the nodes.
+
+Node ids, coordinates, uid, changeset and version are written as fixed-width
+binary columns, one file per column, sorted by id. An attribute a node does
+not have (the uid of an anonymous node, the metadata of PBF dense nodes
+written without info) is stored as the fill value of its column: NaN for
+the coordinates, -1 for uid, changeset and version. The columns can be opened
+with NumPy memory mapping, so analytics jobs get millions of nodes without
+parsing nodes.csv:
+
+    nodes = open_node_store('nodes_store')
+    nodes['lat'][nodes['id'].searchsorted(node_id)]
+"""
+
+import json
+import os
+import sys
+from array import array
+
+
+# column name -> (array typecode, numpy dtype, coerce, fill value of a missing attribute)
+COLUMNS = [
+    ('id', 'q', 'i8', int, None),
+    ('lat', 'd', 'f8', float, float('nan')),
+    ('lon', 'd', 'f8', float, float('nan')),
+    ('uid', 'q', 'i8', int, -1),
+    ('changeset', 'q', 'i8', int, -1),
+    ('version', 'i', 'i4', int, -1),
+]
+META_FILE = 'meta.json'
+FLUSH_SIZE = 65536
+
+
+def _column_path(directory, name):
+    return os.path.join(directory, 'nodes.%s.bin' % name)
+
+
+class NodeStoreWriter(object):
+    """
+    Write the shaped nodes to a columnar store, with the writerow interface
+    of the csv writers.
+    Args:
+                directory (str): directory of the store, created if needed
+                flush_size (int): number of nodes buffered before writing
+    """
+
+    def __init__(self, directory, flush_size=FLUSH_SIZE):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.flush_size = flush_size
+        self.count = 0
+        self.is_sorted = True
+        self.last_id = None
+        self.buffers = [array(code) for _, code, _, _, _ in COLUMNS]
+        self.files = [open(_column_path(directory, name), 'wb') for name, _, _, _, _ in COLUMNS]
+
+    def writerow(self, row):
+        values = []
+        for name, _, _, coerce, fill in COLUMNS:
+            value = row.get(name)
+            values.append(coerce(value) if value is not None else fill)
+        if self.last_id is not None and values[0] < self.last_id:
+            self.is_sorted = False
+        self.last_id = values[0]
+        for buf, value in zip(self.buffers, values):
+            buf.append(value)
+        self.count += 1
+        if len(self.buffers[0]) >= self.flush_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        for buf, column_file in zip(self.buffers, self.files):
+            buf.tofile(column_file)
+            del buf[:]
+
+    def close(self):
+        """Flush the buffers, sort the columns by id if needed and write the metadata"""
+        self.flush()
+        for column_file in self.files:
+            column_file.close()
+        if not self.is_sorted:
+            sort_node_store(self.directory, self.count)
+
+        meta = {
+            'count': self.count,
+            'byteorder': sys.byteorder,
+            'columns': [[name, array(code).itemsize, dtype]
+                        for name, code, dtype, _, _ in COLUMNS],
+        }
+        with open(os.path.join(self.directory, META_FILE), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def sort_node_store(directory, count):
+    """Sort the columns of a store by node id, in place"""
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    if np is not None:
+        ids = np.fromfile(_column_path(directory, 'id'), dtype='=i8', count=count)
+        order = np.argsort(ids, kind='stable')
+        for name, code, dtype, _, _ in COLUMNS:
+            path = _column_path(directory, name)
+            np.fromfile(path, dtype='=' + dtype, count=count)[order].tofile(path)
+        return
+
+    columns = []
+    for name, code, _, _, _ in COLUMNS:
+        column = array(code)
+        with open(_column_path(directory, name), 'rb') as column_file:
+            column.fromfile(column_file, count)
+        columns.append(column)
+    order = sorted(range(count), key=columns[0].__getitem__)
+    for (name, code, _, _, _), column in zip(COLUMNS, columns):
+        with open(_column_path(directory, name), 'wb') as column_file:
+            array(code, (column[i] for i in order)).tofile(column_file)
+
+
+def open_node_store(directory, mode='r'):
+    """
+    Open the columns of a node store as NumPy memory maps.
+    Args:
+                directory (str): directory of the store
+                mode (str): memory map mode, 'r' read only or 'r+' read/write
+    Returns:
+                dict: column name -> numpy.memmap, sorted by id
+    """
+    import numpy as np
+
+    with open(os.path.join(directory, META_FILE)) as meta_file:
+        meta = json.load(meta_file)
+    order = '<' if meta['byteorder'] == 'little' else '>'
+
+    columns = {}
+    for name, _, dtype in meta['columns']:
+        if meta['count'] == 0:
+            columns[name] = np.empty(0, dtype=order + dtype)
+        else:
+            columns[name] = np.memmap(_column_path(directory, name), dtype=order + dtype,
+                                      mode=mode, shape=(meta['count'],))
+    return columns
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Apply an OSM change file (.osc) to a database loaded with load_db.
+
+Only the elements listed in the <create> and <modify> blocks of the change
+file go through shape_element and the corrections, the elements of the
+<delete> blocks are only identified by their type and id. Their rows are
+deleted and re-inserted in place in the element and child tables, so a
+refresh costs time proportional to the size of the diff. The summary tables
+of aggregates, if present, are updated by the difference between the old and
+the new version of each changed element. If the ways table has the
+geometry columns of node_index, the geometry of the changed ways and of the
+ways using a changed node is computed again from the nodes table.
+"""
+
+import sqlite3
+import xml.etree.cElementTree as ET
+from collections import OrderedDict
+
+from aggregates import AggregateCollector, has_aggregates, ELEMENT_TABLES
+from create_RDBMS import shape_element, reload_correctors
+from osm_stream import open_osm
+from load_db import DB_PATH, TABLES, create_tables
+from node_index import way_geometry, WAY_GEOMETRY_FIELDS
+from validation import validate_elements
+
+
+ACTIONS = ('create', 'modify', 'delete')
+BATCH_SIZE = 10000
+
+# tables holding the child rows of nodes, ways and relations
+CHILD_FIELDS = {
+    'node': ('node_tags',),
+    'way': ('way_tags', 'way_nodes'),
+    'relation': ('relation_tags', 'relation_members'),
+}
+
+
+def iter_changes(osc_file):
+    """
+    Yield the elements of an OSM change file with the action applied to them.
+    Args:
+                osc_file (str or file): change file path, possibly .gz or .bz2, or
+                                        binary file object
+    Yields:
+                tuple: (action, element)
+    """
+    close = isinstance(osc_file, str)
+    if close:
+        osc_file = open_osm(osc_file)
+    try:
+        action = None
+        context = ET.iterparse(osc_file, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag in ACTIONS:
+                    action = elem.tag
+            elif elem.tag in CHILD_FIELDS and action is not None:
+                yield action, elem
+                elem.clear()
+            elif elem.tag in ACTIONS:
+                action = None
+                root.clear()
+    finally:
+        if close:
+            osc_file.close()
+
+
+def _row(row, fields):
+    return tuple(row.get(f) for f in fields)
+
+
+def _update_spatial_index(conn, batch):
+    """Keep the R*Tree index of the node coordinates in sync with the nodes table"""
+
+    ids = [(element_id,) for (etype, element_id) in batch if etype == 'node']
+    conn.executemany("DELETE FROM nodes_rtree WHERE id = ?", ids)
+    rows = [(element_id, el['node']['lat'], el['node']['lat'], el['node']['lon'], el['node']['lon'])
+            for (etype, element_id), (action, el) in batch.items()
+            if etype == 'node' and action != 'delete']
+    conn.executemany("INSERT INTO nodes_rtree VALUES (?, ?, ?, ?, ?)", rows)
+
+
+def _has_way_geometry(conn):
+    columns = set(row[1] for row in conn.execute("PRAGMA table_info(ways)"))
+    return all(field in columns for field in WAY_GEOMETRY_FIELDS)
+
+
+def _update_way_geometry(conn, batch):
+    """Recompute the geometry of the changed ways and of the ways of the changed nodes"""
+
+    way_ids = set(element_id for (etype, element_id), (action, _) in batch.items()
+                  if etype == 'way' and action != 'delete')
+    node_ids = [element_id for (etype, element_id) in batch if etype == 'node']
+    for start in range(0, len(node_ids), 500):
+        chunk = node_ids[start:start + 500]
+        way_ids.update(row[0] for row in conn.execute(
+            "SELECT DISTINCT id FROM ways_nodes WHERE node_id IN (%s)" % ",".join("?" * len(chunk)),
+            chunk))
+
+    way_ids = sorted(way_ids)
+    sql = "UPDATE ways SET {0} WHERE id = ?".format(", ".join("%s = ?" % f for f in WAY_GEOMETRY_FIELDS))
+    for start in range(0, len(way_ids), 500):
+        chunk = way_ids[start:start + 500]
+        locations = {way_id: [] for way_id in chunk}
+        for way_id, lat, lon in conn.execute(
+                "SELECT wn.id, n.lat, n.lon FROM ways_nodes wn LEFT JOIN nodes n ON n.id = wn.node_id "
+                "WHERE wn.id IN (%s) ORDER BY wn.id, wn.position" % ",".join("?" * len(chunk)), chunk):
+            locations[way_id].append((lat, lon) if lat is not None else None)
+        rows = []
+        for way_id in chunk:
+            geometry = way_geometry(locations[way_id])
+            rows.append(tuple(geometry[f] for f in WAY_GEOMETRY_FIELDS) + (way_id,))
+        conn.executemany(sql, rows)
+
+
+def _update_aggregates(conn, batch):
+    """Replace the counts of the old versions of the elements by the new ones"""
+    collector = AggregateCollector()
+    for element_type in ELEMENT_TABLES:
+        ids = [element_id for (etype, element_id) in batch if etype == element_type]
+        collector.subtract_existing(conn, element_type, ids)
+    collector([el for (action, el) in batch.values() if action != 'delete'])
+    collector.write(conn)
+
+
+def _apply_batch(conn, batch, spatial_index=False, aggregates=False, geometry=False):
+    """Apply a batch of (element type, id) -> (action, shaped element) changes,
+    the shaped element of a delete being None"""
+
+    if spatial_index:
+        _update_spatial_index(conn, batch)
+    if aggregates:
+        _update_aggregates(conn, batch)
+
+    for element_type, children in CHILD_FIELDS.items():
+        ids = [(element_id,) for (etype, element_id) in batch if etype == element_type]
+        if not ids:
+            continue
+
+        # child rows are always rewritten, and main rows of deleted elements dropped
+        for field in children:
+            conn.executemany("DELETE FROM %s WHERE id = ?" % TABLES[field][0], ids)
+        deleted = [(element_id,) for (etype, element_id), (action, _) in batch.items()
+                   if etype == element_type and action == 'delete']
+        conn.executemany("DELETE FROM %s WHERE id = ?" % TABLES[element_type][0], deleted)
+
+        upserts = [el for (etype, _), (action, el) in batch.items()
+                   if etype == element_type and action != 'delete']
+        for field in (element_type,) + children:
+            table, fields = TABLES[field]
+            verb = "INSERT OR REPLACE" if field == element_type else "INSERT"
+            sql = "{0} INTO {1} ({2}) VALUES ({3})".format(
+                verb, table, ", ".join('"%s"' % f for f in fields), ", ".join("?" * len(fields)))
+            if field == element_type:
+                rows = [_row(el[field], fields) for el in upserts]
+            else:
+                rows = [_row(row, fields) for el in upserts for row in el[field]]
+            conn.executemany(sql, rows)
+
+    if geometry:
+        _update_way_geometry(conn, batch)
+
+
+def apply_changes(osc_file, db_path=DB_PATH, validate=False, batch_size=BATCH_SIZE):
+    """
+    Apply an OSM change file to the database.
+    Args:
+                osc_file (str): change file path
+                db_path (str): path of the SQLite database
+                validate (bool): validate the shaped elements against the schema
+                batch_size (int): number of changed elements applied at once
+    Returns:
+                dict: number of elements per action
+    """
+    counts = dict.fromkeys(ACTIONS, 0)
+    reload_correctors()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        create_tables(conn)
+        spatial_index = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone() is not None
+        aggregates = has_aggregates(conn)
+        geometry = _has_way_geometry(conn)
+        conn.execute("BEGIN")
+
+        # only the last change of an element within a batch matters
+        batch = OrderedDict()
+        for action, element in iter_changes(osc_file):
+            # a deleted element is only removed, its tags are not corrected
+            el = shape_element(element) if action != 'delete' else None
+            if validate is True and el is not None:
+                validate_elements([el])
+            key = (element.tag, int(element.attrib['id']))
+            batch.pop(key, None)
+            batch[key] = (action, el)
+            counts[action] += 1
+            if len(batch) >= batch_size:
+                _apply_batch(conn, batch, spatial_index, aggregates, geometry)
+                batch = OrderedDict()
+        _apply_batch(conn, batch, spatial_index, aggregates, geometry)
+
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return counts
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming helpers shared by the audit modules.
+
+The OSM file is parsed once with iterparse and every top level element is
+cleared as soon as it has been processed, so memory stays flat no matter how
+big the input file is. The tags of .osm.pbf files are decoded by
+pbf_backend instead.
+
+open_osm opens .osm.gz and .osm.bz2 files transparently: the file is
+decompressed by a background thread into a bounded queue of blocks, so the
+decompression overlaps with the parsing and nothing is written to disk.
+"""
+
+import bz2
+import gzip
+import io
+import threading
+import xml.etree.cElementTree as ET
+from queue import Queue, Empty, Full
+
+
+# decompressed bytes per block and number of blocks read ahead
+READ_AHEAD_SIZE = 1024 * 1024
+READ_AHEAD_BLOCKS = 8
+
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open}
+
+
+def is_compressed(osmfile):
+    """Return True if the OSM file path names a gzip or bzip2 file"""
+    return isinstance(osmfile, str) and osmfile.endswith(tuple(COMPRESSED_OPENERS))
+
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    Binary file object reading a compressed file decompressed by a
+    background thread. At most blocks decompressed blocks of block_size
+    bytes are buffered.
+    """
+
+    def __init__(self, compressed_file, block_size=READ_AHEAD_SIZE, blocks=READ_AHEAD_BLOCKS):
+        super(ReadAheadReader, self).__init__()
+        self.compressed_file = compressed_file
+        self.block_size = block_size
+        self.queue = Queue(maxsize=blocks)
+        self.stopped = threading.Event()
+        self.block = b''
+        self.offset = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _decompress(self):
+        try:
+            while True:
+                data = self.compressed_file.read(self.block_size)
+                if not self._put(data) or not data:
+                    return
+        except Exception as error:
+            # raised again in the reading thread
+            self._put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.block):
+            if self.eof:
+                return 0
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            if not item:
+                self.eof = True
+                return 0
+            self.block = item
+            self.offset = 0
+        n = min(len(buffer), len(self.block) - self.offset)
+        buffer[:n] = self.block[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            # unblock the decompression thread
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Empty:
+                pass
+            self.thread.join()
+            self.compressed_file.close()
+        super(ReadAheadReader, self).close()
+
+
+def open_osm(osmfile):
+    """
+    Open an OSM file for binary reading, decompressing .gz and .bz2 files.
+    Args:
+                osmfile (str): file path
+    Returns:
+                file: binary file object
+    """
+    for suffix, opener in COMPRESSED_OPENERS.items():
+        if osmfile.endswith(suffix):
+            return ReadAheadReader(opener(osmfile, 'rb'))
+    return open(osmfile, 'rb')
+
+
+def iter_elements(osmfile, tags=('node', 'way')):
+    """
+    Yield the top level elements of an OSM file, clearing them afterwards.
+    Args:
+                osmfile (str): file path
+                tags (tuple): top level tags to yield
+    Yields:
+                Element: fully parsed top level element
+    """
+    with open_osm(osmfile) as osm_file:
+        context = ET.iterparse(osm_file, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+
+
+def iter_tags(osmfile, tags=('node', 'way'), element_filter=None):
+    """
+    Yield the secondary tags of every top level element of an OSM file.
+    Args:
+                osmfile (str): file path
+                tags (tuple): top level tags whose secondary tags are yielded
+                element_filter (ElementFilter): only the elements passing this
+                                                filter, see element_filter
+    Yields:
+                tuple: (top level tag, tag key, tag value)
+    """
+    if isinstance(osmfile, str) and osmfile.endswith('.pbf'):
+        from pbf_backend import iter_pbf_tags
+        yield from iter_pbf_tags(osmfile, tags, element_filter)
+        return
+    if element_filter is not None:
+        element_filter = element_filter.start()
+    for elem in iter_elements(osmfile, tags):
+        if element_filter is not None and not element_filter.accept_element(elem):
+            continue
+        for tag in elem.iter('tag'):
+            yield elem.tag, tag.attrib['k'], tag.attrib['v']
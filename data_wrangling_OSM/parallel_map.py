@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel version of create_RDBMS.process_map.
+
+The OSM file is split in byte ranges that start on a top level <node, <way or
+<relation element, so every range is a sequence of complete elements. Each
+range is wrapped in an <osm> root, shaped and written to its own part files
+by a pool of processes. The part files are then appended to the five csv
+files in the order of the ranges, so the output is identical to the serial
+path.
+"""
+
+import codecs
+import io
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+from create_RDBMS import iter_shaped, open_writers, write_shaped, CORRECTORS, OUTPUT_PATHS
+from instrumentation import PipelineStats, NULL_STATS
+
+
+ELEMENT_STARTS = (b'<node ', b'<way ', b'<relation ', b'<node>', b'<way>', b'<relation>')
+OSM_END = b'</osm>'
+CHUNK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def _next_element_start(osm_file, offset):
+    """Return the offset of the first top level element starting at or after offset"""
+
+    overlap = max(len(start) for start in ELEMENT_STARTS) - 1
+    osm_file.seek(offset)
+    position = offset
+    tail = b''
+    while True:
+        block = osm_file.read(READ_SIZE)
+        if not block:
+            return None
+        data = tail + block
+        found = [data.find(start) for start in ELEMENT_STARTS]
+        found = [i for i in found if i >= 0]
+        if found:
+            return position - len(tail) + min(found)
+        tail = data[-overlap:]
+        position += len(block)
+
+
+def find_chunks(file_in, n_chunks):
+    """
+    Split an OSM file in byte ranges aligned on top level element boundaries.
+    Args:
+                file_in (str): OSM file path
+                n_chunks (int): requested number of ranges
+    Returns:
+                list: (start, end) byte offsets of each range, in file order
+    """
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as osm_file:
+        first = _next_element_start(osm_file, 0)
+        if first is None:
+            return []
+
+        # the last range ends where the root element is closed
+        osm_file.seek(max(size - READ_SIZE, 0))
+        end = osm_file.read().rfind(OSM_END)
+        end = max(size - READ_SIZE, 0) + end if end >= 0 else size
+
+        bounds = [first]
+        step = max((end - first) // n_chunks, 1)
+        for i in range(1, n_chunks):
+            start = _next_element_start(osm_file, first + i * step)
+            if start is None or start >= end:
+                break
+            if start > bounds[-1]:
+                bounds.append(start)
+        bounds.append(end)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _process_chunk(args):
+    """Shape the elements of a byte range and write them to part files"""
+
+    file_in, start, end, validate, part_dir, index, backend, with_stats = args
+    stats = PipelineStats(progress_every=0) if with_stats else None
+
+    with open(file_in, 'rb') as osm_file:
+        osm_file.seek(start)
+        data = osm_file.read(end - start)
+    chunk = io.BytesIO(b'<osm>' + data + OSM_END)
+
+    part_paths = [os.path.join(part_dir, '%d_%s' % (index, os.path.basename(path)))
+                  for path in OUTPUT_PATHS]
+    with codecs.open(part_paths[0], 'w') as nodes_file, \
+         codecs.open(part_paths[1], 'w') as nodes_tags_file, \
+         codecs.open(part_paths[2], 'w') as ways_file, \
+         codecs.open(part_paths[3], 'w') as way_nodes_file, \
+         codecs.open(part_paths[4], 'w') as way_tags_file:
+
+        writers = open_writers(nodes_file, nodes_tags_file, ways_file,
+                               way_nodes_file, way_tags_file, header=False)
+        with (stats or NULL_STATS).instrument_correctors(CORRECTORS):
+            write_shaped(iter_shaped(chunk, backend, stats=stats), writers, validate, stats=stats)
+
+    return part_paths, stats.summary() if stats is not None else None
+
+
+def process_map_parallel(file_in, validate, workers, chunk_size=CHUNK_SIZE, backend='etree',
+                         stats=None):
+    """
+    Process an OSM file with a pool of processes and write the csv(s).
+    Args:
+                file_in (str): OSM file path
+                validate (bool): validate the shaped elements against the schema
+                workers (int): number of processes
+                chunk_size (int): approximate size in bytes of each byte range
+                backend (str): XML parser backend, 'etree' or 'expat'
+                stats (PipelineStats): collects the timings and counters of all workers,
+                                       stage times are summed over the workers
+    """
+    n_chunks = max(workers, os.path.getsize(file_in) // chunk_size)
+    chunks = find_chunks(file_in, n_chunks)
+
+    part_dir = tempfile.mkdtemp(prefix='osm_parts_', dir=os.path.dirname(os.path.abspath(OUTPUT_PATHS[0])))
+    try:
+        # write the headers through the same writers used by the serial path
+        with codecs.open(OUTPUT_PATHS[0], 'w') as nodes_file, \
+             codecs.open(OUTPUT_PATHS[1], 'w') as nodes_tags_file, \
+             codecs.open(OUTPUT_PATHS[2], 'w') as ways_file, \
+             codecs.open(OUTPUT_PATHS[3], 'w') as way_nodes_file, \
+             codecs.open(OUTPUT_PATHS[4], 'w') as way_tags_file:
+            open_writers(nodes_file, nodes_tags_file, ways_file, way_nodes_file, way_tags_file)
+
+        tasks = [(file_in, start, end, validate, part_dir, index, backend, stats is not None)
+                 for index, (start, end) in enumerate(chunks)]
+
+        outputs = [open(path, 'ab') for path in OUTPUT_PATHS]
+        try:
+            with Pool(workers) as pool:
+                # imap returns the parts in range order, so they are merged deterministically
+                for part_paths, summary in pool.imap(_process_chunk, tasks):
+                    for output, part_path in zip(outputs, part_paths):
+                        with open(part_path, 'rb') as part:
+                            shutil.copyfileobj(part, output)
+                        os.remove(part_path)
+                    if stats is not None:
+                        stats.merge(summary)
+                        stats.elements_done([])
+        finally:
+            for output in outputs:
+                output.close()
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+    if stats is not None:
+        stats.finish(OUTPUT_PATHS)
@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+"""
+OSM PBF parser backend.
+
+A .osm.pbf file is a sequence of blobs, each one a zlib (or lzma) compressed
+protobuf block of a few thousand nodes or ways. The blocks are decoded with a
+small pure-Python protobuf reader, dense nodes and ways are turned into the
+same shaped elements returned by create_RDBMS.shape_element, with every tag
+value going through shape_tag and the correctors. The blocks are independent,
+so with workers > 1 they are decoded and shaped by a pool of processes while
+the elements are yielded in file order:
+
+    process_map('mestre.osm.pbf', validate=True, backend='pbf', workers=4)
+
+Relations are decoded when asked for; a relation never spans more than
+its block, so it is shaped at once. The optional fields of the format
+(visible flags, way node locations) are skipped.
+"""
+
+import lzma
+import struct
+import time
+import zlib
+from collections import deque
+from multiprocessing import Pool
+
+from create_RDBMS import shape_tag, RelationShaper
+from records import NodeRecord, WayRecord
+
+
+# blocks decoded by each worker task
+BLOCKS_PER_TASK = 4
+# tasks submitted to the pool and not yet consumed, per worker. When the
+# consumer (the csv or database writers) is slower than the decoding, at
+# most workers * TASKS_PER_WORKER * BLOCKS_PER_TASK blocks are held, read or
+# decoded, instead of the whole file
+TASKS_PER_WORKER = 2
+
+# Relation.MemberType enum values
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+
+# ================================================== #
+#               Protobuf wire format                 #
+# ================================================== #
+
+def _varint(buf, pos):
+    """Decode the varint at buf[pos], return (value, next position)"""
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _signed(n):
+    """Two's complement of a 64 bit varint (int32/int64 fields)"""
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+
+def iter_fields(buf):
+    """
+    Yield the fields of a protobuf message.
+    Args:
+                buf (bytes): encoded message
+    Yields:
+                tuple: (field number, value), value is an int for varints and
+                       bytes for length delimited fields
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("unsupported protobuf wire type: %d" % wire_type)
+        yield key >> 3, value
+
+
+def packed_varints(buf):
+    """Decode a packed repeated varint field"""
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        b = buf[pos]
+        if b < 0x80:
+            append(b)
+            pos += 1
+        else:
+            value, pos = _varint(buf, pos)
+            append(value)
+    return values
+
+
+def _delta(values):
+    """Undo the delta coding of a packed zigzag field"""
+    total = 0
+    out = []
+    for n in values:
+        total += (n >> 1) ^ -(n & 1)
+        out.append(total)
+    return out
+
+
+# ================================================== #
+#               Blobs                                #
+# ================================================== #
+
+def iter_blobs(osm_file):
+    """
+    Yield the blobs of a PBF file.
+    Args:
+                osm_file (str or file): PBF file path or binary file object
+    Yields:
+                tuple: (blob type, encoded Blob message)
+    """
+    close = False
+    if isinstance(osm_file, str):
+        osm_file = open(osm_file, 'rb')
+        close = True
+    try:
+        while True:
+            size = osm_file.read(4)
+            if len(size) < 4:
+                break
+            header = osm_file.read(struct.unpack('>I', size)[0])
+            blob_type = None
+            data_size = 0
+            for number, value in iter_fields(header):
+                if number == 1:
+                    blob_type = value.decode('utf-8')
+                elif number == 3:
+                    data_size = value
+            yield blob_type, osm_file.read(data_size)
+    finally:
+        if close:
+            osm_file.close()
+
+
+def decompress_blob(blob):
+    """Return the raw block data of an encoded Blob message"""
+    for number, value in iter_fields(blob):
+        if number == 1:
+            return value
+        if number == 3:
+            return zlib.decompress(value)
+        if number == 4:
+            return lzma.decompress(value)
+    raise ValueError("unsupported PBF blob compression")
+
+
+# ================================================== #
+#               Primitive blocks                     #
+# ================================================== #
+
+def _format_coordinate(nano):
+    """Format nanodegrees with the 7 decimals of the XML attributes"""
+    sign = '-' if nano < 0 else ''
+    degrees, fraction = divmod(abs(nano), 1000000000)
+    if fraction % 100:
+        return '%s%d.%09d' % (sign, degrees, fraction)
+    return '%s%d.%07d' % (sign, degrees, fraction // 100)
+
+
+def _format_timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+class PrimitiveBlock(object):
+    """Decoded string table and coordinate scaling of a primitive block"""
+
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.date_granularity = 1000
+        self.lat_offset = 0
+        self.lon_offset = 0
+        for number, value in iter_fields(data):
+            if number == 1:
+                self.strings = [s.decode('utf-8') for n, s in iter_fields(value) if n == 1]
+            elif number == 2:
+                self.groups.append(value)
+            elif number == 17:
+                self.granularity = value
+            elif number == 18:
+                self.date_granularity = value
+            elif number == 19:
+                self.lat_offset = _signed(value)
+            elif number == 20:
+                self.lon_offset = _signed(value)
+
+    def info(self, attribs, version, timestamp, changeset, uid, user_sid):
+        """Add the metadata attributes of an element"""
+        attribs['version'] = str(version)
+        attribs['timestamp'] = _format_timestamp(timestamp * self.date_granularity // 1000)
+        attribs['changeset'] = str(changeset)
+        attribs['uid'] = str(uid)
+        attribs['user'] = self.strings[user_sid]
+
+    def lat(self, lat):
+        return _format_coordinate(self.lat_offset + self.granularity * lat)
+
+    def lon(self, lon):
+        return _format_coordinate(self.lon_offset + self.granularity * lon)
+
+    def iter_raw(self, tags=('node', 'way')):
+        """
+        Yield the elements of the block with their uncorrected tags.
+        Yields:
+                tuple: (element type, attributes, [(key, value)], node refs or
+                       relation members)
+        """
+        for group in self.groups:
+            for number, value in iter_fields(group):
+                if number == 2 and 'node' in tags:
+                    for element in self._dense_nodes(value):
+                        yield element
+                elif number == 1 and 'node' in tags:
+                    yield self._node(value)
+                elif number == 3 and 'way' in tags:
+                    yield self._way(value)
+                elif number == 4 and 'relation' in tags:
+                    yield self._relation(value)
+
+    def _read_info(self, buf, attribs):
+        info = [0, 0, 0, 0, 0]
+        for number, value in iter_fields(buf):
+            if 1 <= number <= 5:
+                info[number - 1] = _signed(value)
+        self.info(attribs, *info)
+
+    def _keys_vals(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+    def _node(self, buf):
+        attribs = {}
+        keys = vals = ()
+        lat = lon = 0
+        for number, value in iter_fields(buf):
+            if number == 1:
+                attribs['id'] = str(_zigzag(value))
+            elif number == 2:
+                keys = packed_varints(value)
+            elif number == 3:
+                vals = packed_varints(value)
+            elif number == 4:
+                self._read_info(value, attribs)
+            elif number == 8:
+                lat = _zigzag(value)
+            elif number == 9:
+                lon = _zigzag(value)
+        attribs['lat'] = self.lat(lat)
+        attribs['lon'] = self.lon(lon)
+        return 'node', attribs, self._keys_vals(keys, vals), None
+
+    def _way(self, buf):
+        attribs = {}
+        keys = vals = refs = ()
+        for number, value in iter_fields(buf):
+            if number == 1:
+                attribs['id'] = str(value)
+            elif number == 2:
+                keys = packed_varints(value)
+            elif number == 3:
+                vals = packed_varints(value)
+            elif number == 4:
+                self._read_info(value, attribs)
+            elif number == 8:
+                refs = _delta(packed_varints(value))
+        return 'way', attribs, self._keys_vals(keys, vals), refs
+
+    def _relation(self, buf):
+        attribs = {}
+        keys = vals = roles = member_ids = member_types = ()
+        for number, value in iter_fields(buf):
+            if number == 1:
+                attribs['id'] = str(value)
+            elif number == 2:
+                keys = packed_varints(value)
+            elif number == 3:
+                vals = packed_varints(value)
+            elif number == 4:
+                self._read_info(value, attribs)
+            elif number == 8:
+                roles = packed_varints(value)
+            elif number == 9:
+                member_ids = _delta(packed_varints(value))
+            elif number == 10:
+                member_types = packed_varints(value)
+        members = [(MEMBER_TYPES[member_type], str(ref), self.strings[role])
+                   for member_type, ref, role in zip(member_types, member_ids, roles)]
+        return 'relation', attribs, self._keys_vals(keys, vals), members
+
+    def _dense_nodes(self, buf):
+        ids = lats = lons = keys_vals = ()
+        info = None
+        for number, value in iter_fields(buf):
+            if number == 1:
+                ids = _delta(packed_varints(value))
+            elif number == 5:
+                info = value
+            elif number == 8:
+                lats = _delta(packed_varints(value))
+            elif number == 9:
+                lons = _delta(packed_varints(value))
+            elif number == 10:
+                keys_vals = packed_varints(value)
+
+        columns = {}
+        if info is not None:
+            for number, value in iter_fields(info):
+                if number == 1:
+                    columns[number] = packed_varints(value)
+                elif 2 <= number <= 5:
+                    columns[number] = _delta(packed_varints(value))
+
+        strings = self.strings
+        kv_pos = 0
+        for i, element_id in enumerate(ids):
+            attribs = {'id': str(element_id)}
+            if columns:
+                self.info(attribs, *[columns[n][i] if n in columns else 0 for n in range(1, 6)])
+            attribs['lat'] = self.lat(lats[i])
+            attribs['lon'] = self.lon(lons[i])
+
+            # keys_vals is a flat list of key, value string ids, each node ends with a 0
+            tags = []
+            while kv_pos < len(keys_vals) and keys_vals[kv_pos] != 0:
+                tags.append((strings[keys_vals[kv_pos]], strings[keys_vals[kv_pos + 1]]))
+                kv_pos += 2
+            kv_pos += 1
+            yield 'node', attribs, tags, None
+
+
+# ================================================== #
+#               Shaped elements                      #
+# ================================================== #
+
+def _shape_relation(attribs, tags, members):
+    relation = RelationShaper(attribs, chunk_size=None)
+    for member in members:
+        relation.add_member(*member)
+    for k, v in tags:
+        relation.add_tag(k, v)
+    return relation.finish()
+
+
+def shape_raw(element_type, attribs, tags, refs):
+    """Shape a decoded element like shape_element"""
+    if element_type == 'relation':
+        return _shape_relation(attribs, tags, refs)
+    element_id = attribs['id']
+    shaped_tags = []
+    for k, v in tags:
+        dict_subtag = shape_tag(element_id, k, v)
+        if dict_subtag is not None:
+            shaped_tags.append(dict_subtag)
+    if element_type == 'node':
+        return {'node': attribs, 'node_tags': shaped_tags}
+    way_nodes = [{'id': element_id, 'node_id': str(ref), 'position': position}
+                 for position, ref in enumerate(refs)]
+    return {'way': attribs, 'way_nodes': way_nodes, 'way_tags': shaped_tags}
+
+
+def record_raw(element_type, attribs, tags, refs):
+    """Build the compact record of a decoded element, see records"""
+    if element_type == 'relation':
+        return _shape_relation(attribs, tags, refs)
+    if element_type == 'node':
+        record = NodeRecord(attribs)
+    else:
+        record = WayRecord(attribs)
+        record.add_refs(refs)
+    for k, v in tags:
+        record.add_tag(k, v)
+    return record
+
+
+def _decode_blobs(args):
+    """Decode and shape a list of OSMData blobs, run in the worker processes"""
+    blobs, tags, shape = args
+    shaped = []
+    for blob in blobs:
+        block = PrimitiveBlock(decompress_blob(blob))
+        shaped.extend(shape(*element) for element in block.iter_raw(tags))
+    return shaped
+
+
+def _decode_raw_blobs(args):
+    """Decode a list of OSMData blobs without shaping, run in the worker processes"""
+    blobs, tags, _ = args
+    raw = []
+    for blob in blobs:
+        raw.extend(PrimitiveBlock(decompress_blob(blob)).iter_raw(tags))
+    return raw
+
+
+def _iter_tasks(osm_file, tags, shape):
+    task = []
+    for blob_type, blob in iter_blobs(osm_file):
+        if blob_type != 'OSMData':
+            continue
+        task.append(blob)
+        if len(task) >= BLOCKS_PER_TASK:
+            yield task, tags, shape
+            task = []
+    if task:
+        yield task, tags, shape
+
+
+def _imap_bounded(pool, func, tasks, max_in_flight):
+    """Like pool.imap, but with at most max_in_flight tasks submitted and not yet consumed"""
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_raw_pbf(osm_file, tags=('node', 'way')):
+    """
+    Yield the elements of a PBF file with their uncorrected tags.
+    Args:
+                osm_file (str or file): PBF file path or binary file object
+                tags (tuple): element types to yield, node and/or way
+    Yields:
+                tuple: (element type, attributes, [(key, value)], node refs)
+    """
+    for blob_type, blob in iter_blobs(osm_file):
+        if blob_type == 'OSMData':
+            for element in PrimitiveBlock(decompress_blob(blob)).iter_raw(tags):
+                yield element
+
+
+def iter_shaped_pbf(osm_file, tags=('node', 'way'), workers=1, shape=shape_raw,
+                    element_filter=None):
+    """
+    Yield the shaped elements of a PBF file.
+    Args:
+                osm_file (str or file): PBF file path or binary file object
+                tags (tuple): element types to yield, node and/or way
+                workers (int): processes decoding the blocks
+                shape (callable): shapes the decoded elements, shape_raw or record_raw
+                element_filter (ElementFilter): only shape the elements passing this
+                                                filter, see element_filter
+    Yields:
+                dict: shaped element, as returned by shape_element
+    """
+    if element_filter is not None:
+        # the filter keeps state across blocks, it runs here on the decoded elements
+        element_filter = element_filter.start()
+        if workers <= 1:
+            raw_elements = iter_raw_pbf(osm_file, tags)
+        else:
+            raw_elements = _iter_raw_parallel(osm_file, tags, workers)
+        for element in raw_elements:
+            if element_filter.accept(*element):
+                yield shape(*element)
+        return
+
+    if workers <= 1:
+        for element in iter_raw_pbf(osm_file, tags):
+            yield shape(*element)
+        return
+
+    with Pool(workers) as pool:
+        for shaped in _imap_bounded(pool, _decode_blobs, _iter_tasks(osm_file, tags, shape),
+                                    workers * TASKS_PER_WORKER):
+            for element in shaped:
+                yield element
+
+
+def _iter_raw_parallel(osm_file, tags, workers):
+    with Pool(workers) as pool:
+        for raw in _imap_bounded(pool, _decode_raw_blobs, _iter_tasks(osm_file, tags, None),
+                                 workers * TASKS_PER_WORKER):
+            for element in raw:
+                yield element
+
+
+def iter_records_pbf(osm_file, tags=('node', 'way'), workers=1, element_filter=None):
+    """Yield the compact records of a PBF file, see records"""
+    return iter_shaped_pbf(osm_file, tags, workers, record_raw, element_filter)
+
+
+def iter_pbf_tags(osm_file, tags=('node', 'way'), element_filter=None):
+    """Yield (element type, key, value) of the uncorrected tags, see osm_stream.iter_tags"""
+    if element_filter is not None:
+        element_filter = element_filter.start()
+    for element_type, attribs, element_tags, refs in iter_raw_pbf(osm_file, tags):
+        if element_filter is not None and not element_filter.accept(element_type, attribs,
+                                                                    element_tags, refs):
+            continue
+        for k, v in element_tags:
+            yield element_type, k, v
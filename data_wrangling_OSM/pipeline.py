@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined csv output.
+
+The csv run is split in stages connected by bounded queues, each stage on
+its own thread:
+
+    reader       parses and shapes the elements, in batches
+    transformer  validates and transforms a batch, then turns it into tuple
+                 rows per table
+    writers      one per output table, writing the batches of rows through a
+                 large write buffer
+
+so the disk writes (and the decompression of compressed input) overlap with
+parsing and shaping. The rows are encoded the way UnicodeDictWriter encodes
+them, so the csv files are byte-identical to the ones of write_shaped.
+
+Without a transform the elements travel as the compact records of records
+from the parser to the writers, otherwise as shaped dicts.
+"""
+
+import csv
+import threading
+from queue import Queue, Empty, Full
+
+from create_RDBMS import (iter_shaped, NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS,
+                          WAY_TAGS_FIELDS, RELATION_FIELDS, RELATION_MEMBERS_FIELDS,
+                          RELATION_TAGS_FIELDS, VALIDATION_BATCH)
+from instrumentation import NULL_STATS
+from records import iter_records, validate_records
+from validation import validate_elements
+
+
+# batches buffered between two stages
+QUEUE_SIZE = 8
+# bytes buffered by each csv file before a write
+WRITE_BUFFER = 1024 * 1024
+
+# shaped element field -> fields of its csv table, in output order
+TABLE_FIELDS = [
+    ('node', NODE_FIELDS),
+    ('node_tags', NODE_TAGS_FIELDS),
+    ('way', WAY_FIELDS),
+    ('way_nodes', WAY_NODES_FIELDS),
+    ('way_tags', WAY_TAGS_FIELDS),
+    ('relation', RELATION_FIELDS),
+    ('relation_members', RELATION_MEMBERS_FIELDS),
+    ('relation_tags', RELATION_TAGS_FIELDS),
+]
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    """Raised in a stage when another stage failed"""
+
+
+class Pipeline(object):
+    """Threads connected by bounded queues, stopped by the first error"""
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.stopped = threading.Event()
+        self.error = None
+        self.threads = []
+
+    def queue(self):
+        return Queue(maxsize=self.queue_size)
+
+    def put(self, queue, item):
+        while True:
+            if self.stopped.is_set():
+                raise _Stopped()
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def get(self, queue):
+        while True:
+            if self.stopped.is_set():
+                raise _Stopped()
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+    def iter_queue(self, queue):
+        """Yield the items of a queue until the end marker"""
+        while True:
+            item = self.get(queue)
+            if item is _DONE:
+                return
+            yield item
+
+    def start(self, target, *args):
+        thread = threading.Thread(target=self._run, args=(target,) + args, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def _run(self, target, *args):
+        try:
+            target(*args)
+        except _Stopped:
+            pass
+        except BaseException as error:
+            if self.error is None:
+                self.error = error
+            self.stopped.set()
+
+    def join(self):
+        """Wait for all the stages, raising the first error of any of them"""
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def encode_row(row, fields):
+    """Tuple row of a shaped row, encoded like UnicodeDictWriter"""
+    return tuple((row[f].encode('utf-8') if isinstance(row[f], str) else row[f]) if f in row else ''
+                 for f in fields)
+
+
+def _read(pipeline, shaped, out, batch_size):
+    batch = []
+    for el in shaped:
+        if el:
+            batch.append(el)
+            if len(batch) >= batch_size:
+                pipeline.put(out, batch)
+                batch = []
+    if batch:
+        pipeline.put(out, batch)
+    pipeline.put(out, _DONE)
+
+
+def _shaped_rows(batch, table_fields):
+    rows = {field: [] for field in table_fields}
+    for el in batch:
+        for field, value in el.items():
+            fields = table_fields[field]
+            if isinstance(value, list):
+                rows[field].extend(encode_row(row, fields) for row in value)
+            else:
+                rows[field].append(encode_row(value, fields))
+    return rows
+
+
+def _record_rows(batch, table_fields):
+    rows = {field: [] for field in table_fields}
+    relations = []
+    for record in batch:
+        if isinstance(record, dict):
+            relations.append(record)
+            continue
+        for field, table_rows in record.rows(table_fields[record.field]):
+            rows[field].extend(table_rows)
+    if relations:
+        for field, table_rows in _shaped_rows(relations, table_fields).items():
+            rows[field].extend(table_rows)
+    return rows
+
+
+def _transform(pipeline, batches, table_queues, table_fields, validate, transform, stats):
+    for batch in pipeline.iter_queue(batches):
+        if transform is None:
+            if validate is True:
+                with stats.stage('validate'):
+                    validate_records(batch)
+            with stats.stage('rows'):
+                rows = _record_rows(batch, table_fields)
+        else:
+            if validate is True:
+                with stats.stage('validate'):
+                    validate_elements(batch)
+            with stats.stage('transform'):
+                transform(batch)
+            with stats.stage('rows'):
+                rows = _shaped_rows(batch, table_fields)
+        for field, queue in table_queues.items():
+            if rows[field]:
+                pipeline.put(queue, rows[field])
+        stats.elements_done(batch)
+    for queue in table_queues.values():
+        pipeline.put(queue, _DONE)
+
+
+def _write(pipeline, batches, csv_file, fields, stats, stage):
+    writer = csv.writer(csv_file)
+    writer.writerow(encode_row(dict(zip(fields, fields)), fields))
+    for rows in pipeline.iter_queue(batches):
+        with stats.stage(stage):
+            writer.writerows(rows)
+
+
+def process_map_pipelined(file_in, validate, output_paths, backend='etree', stats=None,
+                          transform=None, way_fields=WAY_FIELDS, workers=1,
+                          batch_size=VALIDATION_BATCH, queue_size=QUEUE_SIZE,
+                          tags=('node', 'way'), element_filter=None):
+    """
+    Process each element and write to the csv(s) with pipelined stages.
+    Args:
+                file_in (str): OSM file path
+                validate (bool): validate the shaped elements against the schema
+                output_paths (list): csv paths of nodes, node tags, ways, way nodes
+                                     and way tags, then relations, relation members
+                                     and relation tags if tags has 'relation'
+                backend (str): parser backend, see create_RDBMS.iter_shaped
+                stats (PipelineStats): collects timings and counters of the run
+                transform (callable): transform(batch) applied to the validated batches
+                way_fields (list): columns of the ways table
+                workers (int): processes decoding the blocks of a .osm.pbf file
+                batch_size (int): shaped elements per batch
+                queue_size (int): batches buffered between two stages
+                tags (tuple): element types processed
+                element_filter (ElementFilter): only process the elements passing
+                                                this filter, see element_filter
+    """
+    stats_or_null = stats if stats is not None else NULL_STATS
+    table_fields = [(field, way_fields if field == 'way' else fields)
+                    for field, fields in TABLE_FIELDS[:len(output_paths)]]
+
+    pipeline = Pipeline(queue_size)
+    batches = pipeline.queue()
+    table_queues = {field: pipeline.queue() for field, _ in table_fields}
+    files = [open(path, 'w', buffering=WRITE_BUFFER) for path in output_paths]
+    try:
+        if transform is None:
+            shaped = iter_records(file_in, backend, tags, workers=workers,
+                                  element_filter=element_filter, stats=stats)
+        else:
+            shaped = iter_shaped(file_in, backend, tags, stats=stats, workers=workers,
+                                 element_filter=element_filter)
+        pipeline.start(_read, pipeline, shaped, batches, batch_size)
+        pipeline.start(_transform, pipeline, batches, table_queues, dict(table_fields), validate,
+                       transform, stats_or_null)
+        for (field, fields), csv_file in zip(table_fields, files):
+            pipeline.start(_write, pipeline, table_queues[field], csv_file, fields, stats_or_null,
+                           'write_' + field)
+        pipeline.join()
+    finally:
+        pipeline.stopped.set()
+        for csv_file in files:
+            csv_file.close()
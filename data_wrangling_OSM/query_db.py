@@ -6,22 +6,351 @@ Created on Mon Oct 30 18:31:25 2017
 """
 
 # import SQLIte3
+import math
+import os
 import sqlite3
-import numpy as np
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import LifoQueue, Empty, Full
+from urllib.request import pathname2url
+
+from node_index import haversine
+from tag_dictionary import is_encoded
+
+
+FETCH_SIZE = 1000
+POOL_SIZE = 4
+CACHE_SIZE = 128
+
+
+def _print_row(r, n_columns):
+    if n_columns == 1:
+        print(r[0])
+    else:
+        name = str(r[0])
+        # values imported from the csv(s) are stored as b'...' strings
+        if name[:2] in ("b'", 'b"'):
+            name = name[2:-1]
+        print(name + ': ' + str(r[1]))
+
 
 # function for query
-def query_db(QUERY,cursor):
-    cursor.execute(QUERY)
-    results = cursor.fetchall()
-    
-    # print
-    size = np.shape(results)
-    if size[1]==1:
-        for r in results:
-            print(r[0])
+def query_db(QUERY, cursor, params=()):
+    cursor.execute(QUERY, params)
+
+    # print, streaming the rows instead of loading the whole result
+    n_columns = len(cursor.description)
+    for r in cursor:
+        _print_row(r, n_columns)
+
+
+class QueryPool(object):
+    """
+    Pool of read-only connections to the OSM database.
+
+    Statements are parameterized and prepared once per connection (SQLite
+    statement cache), results are streamed with fetchmany and small results
+    can be cached keyed by query and parameters. The cache is dropped as soon
+    as the database file changes.
+    Args:
+        db_path (str): path of the SQLite database
+        size (int): maximum number of idle connections kept open
+        fetch_size (int): rows fetched at a time when streaming
+        cache_size (int): number of cached results, 0 to disable the cache
+    """
+
+    def __init__(self, db_path, size=POOL_SIZE, fetch_size=FETCH_SIZE, cache_size=CACHE_SIZE):
+        self.db_path = db_path
+        self.uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(db_path))
+        self.fetch_size = fetch_size
+        self.cache_size = cache_size
+        self.idle = LifoQueue(maxsize=size)
+        self.cache = OrderedDict()
+        self.cache_version = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        return sqlite3.connect(self.uri, uri=True, check_same_thread=False,
+                               cached_statements=256)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool"""
+        try:
+            conn = self.idle.get_nowait()
+        except Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            try:
+                self.idle.put_nowait(conn)
+            except Full:
+                conn.close()
+
+    def iter_query(self, sql, params=(), fetch_size=None):
+        """
+        Stream the rows of a query.
+        Args:
+            sql (str): parameterized query
+            params (tuple or dict): query parameters
+            fetch_size (int): rows fetched at a time
+        Yields:
+            tuple: result rows
+        """
+        fetch_size = fetch_size or self.fetch_size
+        with self.connection() as conn:
+            cursor = conn.execute(sql, params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        return
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+
+    def _version(self):
+        """Identify the current state of the database files"""
+        version = []
+        for path in (self.db_path, self.db_path + '-wal'):
+            try:
+                st = os.stat(path)
+                version.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                version.append(None)
+        return tuple(version)
+
+    def query(self, sql, params=(), cache=True):
+        """
+        Run a query and return all its rows, from the cache if possible.
+        Args:
+            sql (str): parameterized query
+            params (tuple): query parameters
+            cache (bool): use the result cache
+        Returns:
+            list: result rows
+        """
+        if not cache or not self.cache_size:
+            return list(self.iter_query(sql, params))
+
+        key = (sql, tuple(params))
+        with self.lock:
+            version = self._version()
+            if version != self.cache_version:
+                self.cache.clear()
+                self.cache_version = version
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        rows = list(self.iter_query(sql, params))
+        with self.lock:
+            if self.cache_version == version:
+                self.cache[key] = rows
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return rows
+
+    def close(self):
+        """Close the idle connections"""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                break
+
+
+# ================================================== #
+#               Tag search                           #
+# ================================================== #
+# On a database encoded by tag_dictionary.encode_tags the LIKE pattern is
+# matched against the FTS5 index of the distinct tag values, otherwise it
+# falls back to a scan of the tag table.
+
+def search_tags(cursor, pattern, table='nodes_tags', key=None):
+    """
+    Find the tags whose value matches a LIKE pattern, e.g. '%restaurant%'.
+    Args:
+        cursor: cursor of the OSM database
+        pattern (str): LIKE pattern of the value
+        table (str): 'nodes_tags' or 'ways_tags'
+        key (str): only tags with this key
+    Returns:
+        list: (id, key, value, type) of the matching tags
+    """
+    if table not in ('nodes_tags', 'ways_tags'):
+        raise ValueError("unknown tag table: %s" % table)
+    if is_encoded(cursor.connection, table):
+        sql = ("SELECT t.id, k.key, v.value, ty.type FROM {0}_enc t "
+               "JOIN tag_keys k ON k.id = t.key_id "
+               "JOIN tag_values v ON v.id = t.value_id "
+               "JOIN tag_types ty ON ty.id = t.type_id "
+               "WHERE t.value_id IN (SELECT rowid FROM tag_values_fts WHERE value LIKE ?)").format(table)
+        if key is not None:
+            sql += " AND t.key_id = (SELECT id FROM tag_keys WHERE key = ?)"
     else:
-        for r in results:
-            name = str(r[0])
-            name = name[2:]
-            print(str(name[:-1]) + ': ' + str(r[1]))
-    
\ No newline at end of file
+        sql = "SELECT id, key, value, type FROM {0} WHERE value LIKE ?".format(table)
+        if key is not None:
+            sql += " AND key = ?"
+    cursor.execute(sql, (pattern,) if key is None else (pattern, key))
+    return cursor.fetchall()
+
+
+def count_tags(cursor, pattern, table='nodes_tags', key=None):
+    """Count the tags whose value matches a LIKE pattern, see search_tags"""
+    if table not in ('nodes_tags', 'ways_tags'):
+        raise ValueError("unknown tag table: %s" % table)
+    if is_encoded(cursor.connection, table):
+        sql = ("SELECT COUNT(*) FROM {0}_enc "
+               "WHERE value_id IN (SELECT rowid FROM tag_values_fts WHERE value LIKE ?)").format(table)
+        if key is not None:
+            sql += " AND key_id = (SELECT id FROM tag_keys WHERE key = ?)"
+    else:
+        sql = "SELECT COUNT(*) FROM {0} WHERE value LIKE ?".format(table)
+        if key is not None:
+            sql += " AND key = ?"
+    cursor.execute(sql, (pattern,) if key is None else (pattern, key))
+    return cursor.fetchone()[0]
+
+
+# ================================================== #
+#               Summary tables                       #
+# ================================================== #
+# Lookups in the summary tables kept by aggregates during the load and the
+# change file updates
+
+def top_users(cursor, n=10, element_type=None):
+    """Return the (user, count) of the n users with the most elements, None
+    as the user of the anonymous elements"""
+    sql = "SELECT NULLIF(user, '') AS user, SUM(count) AS total FROM summary_users"
+    params = ()
+    if element_type is not None:
+        sql += " WHERE element_type = ?"
+        params = (element_type,)
+    cursor.execute(sql + " GROUP BY user ORDER BY total DESC LIMIT ?", params + (n,))
+    return cursor.fetchall()
+
+
+def tag_value_counts(cursor, key, element_type=None, n=None):
+    """Return the (value, count) of a tag key, most frequent first"""
+    sql = "SELECT value, SUM(count) AS total FROM summary_tags WHERE key = ?"
+    params = (key,)
+    if element_type is not None:
+        sql += " AND element_type = ?"
+        params += (element_type,)
+    sql += " GROUP BY value ORDER BY total DESC"
+    if n is not None:
+        sql += " LIMIT ?"
+        params += (n,)
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def tag_pair_counts(cursor, key1, value1, key2):
+    """Return the (value, count) of key2 on the elements tagged key1=value1,
+    e.g. the cuisines of the restaurants"""
+    cursor.execute("SELECT value2, SUM(count) AS total FROM summary_tag_pairs "
+                   "WHERE key1 = ? AND value1 = ? AND key2 = ? "
+                   "GROUP BY value2 ORDER BY total DESC", (key1, value1, key2))
+    return cursor.fetchall()
+
+
+# ================================================== #
+#               Spatial queries                      #
+# ================================================== #
+# The queries below use the nodes_rtree R*Tree index built by load_db
+
+METERS_PER_DEGREE = 111320.0
+
+SPATIAL_QUERY = ("SELECT nodes.id, nodes.lat, nodes.lon FROM nodes_rtree "
+                 "JOIN nodes ON nodes.id = nodes_rtree.id "
+                 "WHERE nodes_rtree.min_lat <= ? AND nodes_rtree.max_lat >= ? "
+                 "AND nodes_rtree.min_lon <= ? AND nodes_rtree.max_lon >= ? "
+                 # the R*Tree stores 32 bit floats, check the exact coordinates
+                 "AND nodes.lat BETWEEN ? AND ? AND nodes.lon BETWEEN ? AND ?")
+TAG_FILTER = (" AND EXISTS (SELECT 1 FROM nodes_tags WHERE nodes_tags.id = nodes.id "
+              "AND nodes_tags.key = ?{0})")
+
+
+def _spatial_sql(key, value):
+    """Return the bbox query, filtered by tag key and value if given"""
+    sql = SPATIAL_QUERY
+    params = []
+    if key is not None:
+        sql += TAG_FILTER.format(" AND nodes_tags.value = ?" if value is not None else "")
+        params.append(key)
+        if value is not None:
+            params.append(value)
+    return sql, params
+
+
+def query_bbox(cursor, min_lat, min_lon, max_lat, max_lon, key=None, value=None):
+    """
+    Find the nodes inside a bounding box.
+    Args:
+        cursor: cursor of the OSM database
+        min_lat, min_lon, max_lat, max_lon (float): bounding box
+        key (str): only nodes having a tag with this key
+        value (str): only nodes having the tag key with this value
+    Returns:
+        list: (id, lat, lon) of the nodes found
+    """
+    sql, params = _spatial_sql(key, value)
+    cursor.execute(sql, [max_lat, min_lat, max_lon, min_lon,
+                         min_lat, max_lat, min_lon, max_lon] + params)
+    return cursor.fetchall()
+
+
+def _radius_bbox(lat, lon, radius):
+    """Bounding box containing the circle of radius meters around a point"""
+    dlat = radius / METERS_PER_DEGREE
+    dlon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def query_within(cursor, lat, lon, radius, key=None, value=None):
+    """
+    Find the nodes within a distance of a point, e.g. the cafes within 500 m.
+    Args:
+        cursor: cursor of the OSM database
+        lat, lon (float): center
+        radius (float): distance in meters
+        key (str): only nodes having a tag with this key
+        value (str): only nodes having the tag key with this value
+    Returns:
+        list: (distance, id, lat, lon) of the nodes found, nearest first
+    """
+    found = []
+    for node_id, node_lat, node_lon in query_bbox(cursor, *_radius_bbox(lat, lon, radius),
+                                                   key=key, value=value):
+        distance = haversine(lat, lon, node_lat, node_lon)
+        if distance <= radius:
+            found.append((distance, node_id, node_lat, node_lon))
+    found.sort()
+    return found
+
+
+def query_nearest(cursor, lat, lon, k=1, key=None, value=None, start_radius=100.0,
+                  max_radius=50000.0):
+    """
+    Find the k nodes nearest to a point.
+    The search radius starts at start_radius and doubles until k nodes are
+    found within it or max_radius is reached.
+    Args:
+        cursor: cursor of the OSM database
+        lat, lon (float): point
+        k (int): number of nodes
+        key (str): only nodes having a tag with this key
+        value (str): only nodes having the tag key with this value
+    Returns:
+        list: (distance, id, lat, lon) of the nearest nodes, nearest first
+    """
+    radius = start_radius
+    while True:
+        found = query_within(cursor, lat, lon, radius, key, value)
+        if len(found) >= k or radius >= max_radius:
+            return found[:k]
+        radius = min(radius * 2, max_radius)
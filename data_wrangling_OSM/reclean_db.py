@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Re-clean the tag values of a loaded database after the correction rules
+changed, without parsing the OSM file again.
+
+Only the distinct values of the corrected keys (street, postcode, city,
+phone, province) are read, each one is corrected once, and the values that
+change are written to a temporary table of (key, old value, new value)
+rows. The tag tables are then updated with a few set-based statements
+joining that table, so the cost depends on the number of distinct values
+rather than on the size of the map:
+
+    mapping_street['Calle'] = 'Calle'
+    reclean(db_path='mestre.db', keys=['street'])
+
+Values the new rules drop (phone numbers that cannot be corrected) are
+deleted, values they have no correction for (a strict rule set raising
+KeyError) are left unchanged. Dictionary encoded tag tables (see
+tag_dictionary) are updated through their integer tables, and the summary
+tables of aggregates, if present, follow the new values.
+"""
+
+import sqlite3
+
+from aggregates import AggregateCollector, has_aggregates
+from correction_rules import load_rules
+from load_db import DB_PATH
+from tag_dictionary import is_encoded
+
+
+# element type -> tag table re-cleaned
+TAG_TABLES = {'node': 'nodes_tags', 'way': 'ways_tags', 'relation': 'relations_tags'}
+# distinct values corrected and inserted at once
+BATCH_SIZE = 10000
+
+SQL_RECLEAN = """
+CREATE TEMP TABLE reclean (
+    key TEXT NOT NULL,
+    old TEXT NOT NULL,
+    new TEXT,
+    PRIMARY KEY (key, old)
+)
+"""
+
+SQL_RECLEAN_IDS = """
+CREATE TEMP TABLE reclean_ids AS
+SELECT k.id AS key_id, o.id AS old_id, n.id AS new_id
+FROM reclean r
+JOIN tag_keys k ON k.key = r.key
+JOIN tag_values o ON o.value = r.old
+LEFT JOIN tag_values n ON n.value = r.new
+"""
+
+
+def _tag_tables(conn):
+    """Return the element type -> tag table of TAG_TABLES present in the database,
+    a database loaded from the csv(s) has no relations_tags"""
+    names = {name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+    return {element_type: table for element_type, table in TAG_TABLES.items() if table in names}
+
+
+def _distinct_values(conn, key, tables):
+    """Cursor over the distinct values of a key in the tag tables"""
+    sql = " UNION ".join("SELECT value FROM %s WHERE key = ?" % table for table in tables.values())
+    return conn.execute(sql, (key,) * len(tables))
+
+
+def _collect_corrections(conn, key, corrector, batch_size, tables):
+    """Correct each distinct value of a key once, store the changed ones in reclean"""
+    values = _distinct_values(conn, key, tables)
+    while True:
+        rows = values.fetchmany(batch_size)
+        if not rows:
+            break
+        changed = []
+        for (value,) in rows:
+            try:
+                new = corrector(value)
+            except KeyError:
+                continue
+            if new != value:
+                changed.append((key, value, new))
+        conn.executemany("INSERT INTO reclean VALUES (?, ?, ?)", changed)
+
+
+def _count_changes(conn, tables):
+    """Return (element type, key, old, new) -> number of tag rows to change"""
+    counts = {}
+    for element_type, table in tables.items():
+        for key, old, new, n in conn.execute(
+                "SELECT r.key, r.old, r.new, COUNT(*) FROM reclean r "
+                "JOIN %s t ON t.key = r.key AND t.value = r.old "
+                "GROUP BY r.key, r.old" % table):
+            counts[(element_type, key, old, new)] = n
+    return counts
+
+
+def _update_aggregates(conn, counts):
+    """Move the tag counts of the summary tables from the old to the new values"""
+    # the tag pairs of aggregates.TAG_PAIRS do not involve corrected keys
+    collector = AggregateCollector()
+    for (element_type, key, old, new), n in counts.items():
+        collector.tags[(element_type, key, old)] -= n
+        if new is not None:
+            collector.tags[(element_type, key, new)] += n
+    collector.write(conn)
+
+
+def _apply_plain(conn, table):
+    conn.execute(
+        "UPDATE {0} SET value = (SELECT new FROM reclean r WHERE r.key = {0}.key AND r.old = {0}.value) "
+        "WHERE (key, value) IN (SELECT key, old FROM reclean WHERE new IS NOT NULL)".format(table))
+    conn.execute(
+        "DELETE FROM {0} WHERE (key, value) IN (SELECT key, old FROM reclean WHERE new IS NULL)".format(table))
+
+
+def _apply_encoded(conn, table):
+    # the views would update row by row through their triggers
+    conn.execute(
+        "UPDATE {0}_enc SET value_id = (SELECT new_id FROM reclean_ids r "
+        "WHERE r.key_id = {0}_enc.key_id AND r.old_id = {0}_enc.value_id) "
+        "WHERE (key_id, value_id) IN (SELECT key_id, old_id FROM reclean_ids "
+        "WHERE new_id IS NOT NULL)".format(table))
+    conn.execute(
+        "DELETE FROM {0}_enc WHERE (key_id, value_id) IN "
+        "(SELECT key_id, old_id FROM reclean_ids WHERE new_id IS NULL)".format(table))
+
+
+def reclean(db_path=DB_PATH, keys=None, correctors=None, batch_size=BATCH_SIZE):
+    """
+    Apply the current correction rules to the tag values of a database.
+    Args:
+                db_path (str): path of the SQLite database
+                keys (list): tag keys to re-clean, all the corrected keys if None
+                correctors (dict): tag key -> corrector(value), the rules of
+                                   correction_rules.json loaded afresh if None,
+                                   so changed mapping tables are used
+                batch_size (int): distinct values corrected at once
+    Returns:
+                dict: key -> {'updated': tag rows changed, 'deleted': tag rows dropped}
+    """
+    if correctors is None:
+        correctors = load_rules()
+    if keys is None:
+        keys = list(correctors)
+
+    report = {key: {'updated': 0, 'deleted': 0} for key in keys}
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("BEGIN")
+        conn.execute(SQL_RECLEAN)
+        tables = _tag_tables(conn)
+        for key in keys:
+            _collect_corrections(conn, key, correctors[key], batch_size, tables)
+
+        counts = _count_changes(conn, tables)
+        for (_, key, _, new), n in counts.items():
+            report[key]['updated' if new is not None else 'deleted'] += n
+        if counts and has_aggregates(conn):
+            _update_aggregates(conn, counts)
+
+        if counts:
+            encoded = [table for table in tables.values() if is_encoded(conn, table)]
+            if encoded:
+                conn.execute("INSERT OR IGNORE INTO tag_values (value) "
+                             "SELECT new FROM reclean WHERE new IS NOT NULL")
+                conn.execute(SQL_RECLEAN_IDS)
+            for table in tables.values():
+                if table in encoded:
+                    _apply_encoded(conn, table)
+                else:
+                    _apply_plain(conn, table)
+
+        conn.execute("DROP TABLE IF EXISTS temp.reclean_ids")
+        conn.execute("DROP TABLE temp.reclean")
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return report
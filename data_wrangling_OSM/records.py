@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Compact records of the shaped nodes and ways.
+
+A shaped element of shape_element is a dict per element, plus a dict per
+tag and per way node reference, each repeating the parent id. The records
+below hold the same data in a few slots instead: the attributes dict built
+by the parser, the tag keys, values and types as parallel lists and the
+way node references as an array('q') whose positions are implicit.
+
+The pipelined csv run (see pipeline) carries records from the parser to
+the writers, which get the encoded tuple rows straight from them. Code
+that works on shaped dicts (transforms, the database loaders) can still
+call shaped() on a record. Relations, already streamed in chunks by
+create_RDBMS.RelationShaper, stay shaped dicts.
+"""
+
+from array import array
+
+from create_RDBMS import split_tag, iter_shaped_etree
+from instrumentation import NULL_STATS
+from validation import validate_rows, validate_elements, ValidationError, COMPILED_SCHEMA
+
+
+class NodeRecord(object):
+    """Attributes and tags of a node"""
+
+    __slots__ = ('attribs', 'tag_keys', 'tag_values', 'tag_types')
+    field = 'node'
+    tags_field = 'node_tags'
+
+    def __init__(self, attribs):
+        self.attribs = attribs
+        self.tag_keys = []
+        self.tag_values = []
+        self.tag_types = []
+
+    def add_tag(self, k, v):
+        """Split, correct and append a tag, dropping it if the corrector does"""
+        tag = split_tag(k, v)
+        if tag is not None:
+            self.tag_keys.append(tag[0])
+            self.tag_values.append(tag[1])
+            self.tag_types.append(tag[2])
+
+    def _tags(self):
+        element_id = self.attribs['id']
+        return [{'id': element_id, 'key': k, 'value': v, 'type': t}
+                for k, v, t in zip(self.tag_keys, self.tag_values, self.tag_types)]
+
+    def _tag_rows(self):
+        element_id = self.attribs['id'].encode('utf-8')
+        return [(element_id, k.encode('utf-8'), v.encode('utf-8'), t.encode('utf-8'))
+                for k, v, t in zip(self.tag_keys, self.tag_values, self.tag_types)]
+
+    def shaped(self):
+        """Return the element as shaped by shape_element"""
+        return {'node': self.attribs, 'node_tags': self._tags()}
+
+    def rows(self, fields):
+        """
+        Return the encoded csv rows of the element, see pipeline.encode_row.
+        Args:
+                fields (list): columns of the element table
+        Returns:
+                list: (element field, rows) of each table
+        """
+        return [('node', [encode_attribs(self.attribs, fields)]),
+                ('node_tags', self._tag_rows())]
+
+    def row_counts(self):
+        return [('nodes', 1), ('node_tags', len(self.tag_keys))]
+
+
+class WayRecord(NodeRecord):
+    """Attributes, tags and node references of a way"""
+
+    __slots__ = ('refs',)
+    field = 'way'
+    tags_field = 'way_tags'
+
+    def __init__(self, attribs):
+        super(WayRecord, self).__init__(attribs)
+        self.refs = array('q')
+
+    def add_ref(self, ref):
+        try:
+            self.refs.append(int(ref))
+        except ValueError:
+            # kept as given, like write_shaped does; validate_records rejects it
+            if isinstance(self.refs, array):
+                self.refs = list(self.refs)
+            self.refs.append(ref)
+
+    def add_refs(self, refs):
+        """Append node references, integers or strings"""
+        try:
+            refs = array('q', refs)
+        except (TypeError, ValueError):
+            for ref in refs:
+                self.add_ref(ref)
+        else:
+            self.refs.extend(refs)
+
+    def check_refs(self):
+        """Raise ValidationError if a node reference is not an integer"""
+        if isinstance(self.refs, array):
+            return
+        for ref in self.refs:
+            try:
+                int(ref)
+            except ValueError:
+                raise ValidationError("\nElement of type 'way_nodes' has the following errors:\n"
+                                      "node_id: field '{0}' cannot be coerced".format(ref))
+
+    def shaped(self):
+        element_id = self.attribs['id']
+        way_nodes = [{'id': element_id, 'node_id': str(ref), 'position': position}
+                     for position, ref in enumerate(self.refs)]
+        return {'way': self.attribs, 'way_nodes': way_nodes, 'way_tags': self._tags()}
+
+    def rows(self, fields):
+        element_id = self.attribs['id'].encode('utf-8')
+        way_nodes = [(element_id, str(ref).encode('utf-8'), position)
+                     for position, ref in enumerate(self.refs)]
+        return [('way', [encode_attribs(self.attribs, fields)]),
+                ('way_nodes', way_nodes),
+                ('way_tags', self._tag_rows())]
+
+    def row_counts(self):
+        return [('ways', 1), ('way_tags', len(self.tag_keys)), ('way_nodes', len(self.refs))]
+
+
+def encode_attribs(attribs, fields):
+    """Tuple row of the attributes, encoded like UnicodeDictWriter"""
+    return tuple(attribs[f].encode('utf-8') if f in attribs else '' for f in fields)
+
+
+def record_from_element(element):
+    """Shape a node or way Element into a record"""
+    # the attributes are copied, the element is cleared once parsed
+    if element.tag == 'node':
+        record = NodeRecord(dict(element.attrib))
+    else:
+        record = WayRecord(dict(element.attrib))
+    for child in element:
+        if child.tag == 'tag':
+            record.add_tag(child.attrib['k'], child.attrib['v'])
+        elif child.tag == 'nd' and element.tag == 'way':
+            record.add_ref(child.attrib['ref'])
+    return record
+
+
+def iter_records(file_in, backend='etree', tags=('node', 'way'), workers=1, element_filter=None,
+                 stats=None):
+    """Yield the records of an OSM file parsed with the given backend, and
+    the shaped relations if tags has 'relation'. The stages are timed as in
+    create_RDBMS.iter_shaped"""
+
+    if backend == 'pbf' or (isinstance(file_in, str) and file_in.endswith('.pbf')):
+        from pbf_backend import iter_records_pbf
+        records = iter_records_pbf(file_in, tags, workers, element_filter)
+        return (stats or NULL_STATS).timed_iter(records, 'parse_shape')
+    if backend == 'expat':
+        from expat_backend import iter_shaped_expat
+        records = iter_shaped_expat(file_in, tags, records=True, element_filter=element_filter)
+        return (stats or NULL_STATS).timed_iter(records, 'parse_shape')
+    if backend == 'etree':
+        return iter_shaped_etree(file_in, tags, stats, shape=record_from_element,
+                                 element_filter=element_filter)
+    raise ValueError("unknown parser backend: %s" % backend)
+
+
+def validate_records(records, compiled=COMPILED_SCHEMA):
+    """
+    Validate a batch of records, raising ValidationError on the first error.
+    The tag and way node rows are valid by construction once the attributes
+    are: their id is the element id and their values strings. The node
+    references are checked only for the ways that kept one as a string.
+    """
+    attribs = {}
+    relations = []
+    for record in records:
+        if isinstance(record, dict):
+            relations.append(record)
+        else:
+            attribs.setdefault(record.field, []).append(record.attribs)
+            if record.field == 'way':
+                record.check_refs()
+    for field, rows in attribs.items():
+        validate_rows(field, rows, compiled)
+    if relations:
+        validate_elements(relations, compiled)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic, dirty OSM files for the benchmarks.
+
+The generated elements carry the patterns the cleaners target: Venetian
+street prefixes, malformed +39 phone numbers, 'Venice 30123' style postal
+codes, English suburb names and 'VE' provinces, mixed with clean values and
+plain tags.
+"""
+
+import random
+from xml.sax.saxutils import quoteattr
+
+
+DIRTY_VALUES = {
+    'addr:street': ["Campazzo San Zulian", "Lista di Spagna", "Isola Nuova", "Stazione",
+                    "Dorsoduro, 3246 Campo", "Sestiere Castello", "Carbonera 12",
+                    "salizada samuele 3216", "via Piave", "Fondamente Nove",
+                    "Forte Marghera", "La Giudecca", "santa Croce", "cannaregio 1234"],
+    'addr:postcode': ["Venice 30123", "Venice30123", "Ponte dei Pugni", "PontedeiPugni"],
+    'addr:city': ["Venice", "Marghera VE", "Venezia Mestre", "30173", "3073"],
+    'addr:province': ["VE"],
+    'phone': ["041 5229876", "0039 041 5229876", "+ 39 041 5229876", "041-5229876",
+              "39 041 5229876", "3471234567", "+39 0415229876", "30172"],
+}
+
+CLEAN_VALUES = {
+    'addr:street': ["Via Piave", "Corso del Popolo", "Viale San Marco", "Piazza Ferretto",
+                    "Calle Larga", "Campo San Polo", "Riviera XX Settembre"],
+    'addr:postcode': ["30121", "30170", "30171", "30172", "30173", "30174"],
+    'addr:city': ["Venezia", "Mestre", "Marghera", "Favaro Veneto", "Zelarino"],
+    'addr:province': ["Venezia"],
+    'phone': ["+39 041 5229876", "+39 041 9876543"],
+}
+
+PLAIN_TAGS = [
+    ('amenity', ["restaurant", "cafe", "bar", "pub", "pharmacy", "bank", "school"]),
+    ('cuisine', ["pizza", "italian", "regional", "seafood"]),
+    ('name', ["Da Mario", "Al Ponte", "Bar Centrale", "Trattoria Venezia"]),
+    ('highway', ["bus_stop", "traffic_signals", "crossing"]),
+    ('shop', ["supermarket", "bakery", "clothes"]),
+    ('addr:housenumber', [str(n) for n in range(1, 200)]),
+    ('public_transport', ["platform", "stop_position"]),
+    ('railway', ["tram_stop"]),
+]
+
+USERS = ["alice", "bob", "carla", "dario", "elena", "franco", "giulia", "hugo"]
+BBOX = (45.40, 12.15, 45.55, 12.40)
+
+
+def _tags(rng, tag_density, dirty_ratio):
+    """Return the (k, v) secondary tags of one element"""
+    n_tags = int(rng.expovariate(1.0 / tag_density)) if tag_density > 0 else 0
+    tags = {}
+    for _ in range(n_tags):
+        if rng.random() < 0.5:
+            k = rng.choice(list(DIRTY_VALUES))
+            values = DIRTY_VALUES[k] if rng.random() < dirty_ratio else CLEAN_VALUES[k]
+        else:
+            k, values = rng.choice(PLAIN_TAGS)
+        tags[k] = rng.choice(values)
+    return tags.items()
+
+
+def _attributes(rng, element_id, user_index):
+    return ('id="%d" user=%s uid="%d" version="%d" changeset="%d" timestamp="2017-%02d-%02dT12:00:00Z"'
+            % (element_id, quoteattr(USERS[user_index]), user_index + 1, rng.randint(1, 9),
+               rng.randint(1, 5 * 10 ** 7), rng.randint(1, 12), rng.randint(1, 28)))
+
+
+def write_synthetic_osm(path, n_nodes=100000, way_ratio=0.1, nodes_per_way=8,
+                        tag_density=0.5, dirty_ratio=0.3, seed=0):
+    """
+    Write a synthetic OSM file.
+    Args:
+                path (str): output file path
+                n_nodes (int): number of nodes
+                way_ratio (float): number of ways per node
+                nodes_per_way (int): average number of node references per way
+                tag_density (float): average number of secondary tags per element
+                dirty_ratio (float): fraction of the audited tags with a dirty value
+                seed (int): seed of the random generator
+    Returns:
+                dict: number of nodes, ways and tags written
+    """
+    rng = random.Random(seed)
+    counts = {'nodes': 0, 'ways': 0, 'tags': 0}
+    with open(path, 'w', encoding='utf8') as osm_file:
+        osm_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="synthetic_osm">\n')
+        osm_file.write(' <bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n' % BBOX)
+
+        for node_id in range(1, n_nodes + 1):
+            lat = rng.uniform(BBOX[0], BBOX[2])
+            lon = rng.uniform(BBOX[1], BBOX[3])
+            tags = list(_tags(rng, tag_density, dirty_ratio))
+            attributes = '%s lat="%.7f" lon="%.7f"' % (_attributes(rng, node_id, rng.randrange(len(USERS))), lat, lon)
+            if tags:
+                osm_file.write(' <node %s>\n' % attributes)
+                for k, v in tags:
+                    osm_file.write('  <tag k=%s v=%s/>\n' % (quoteattr(k), quoteattr(v)))
+                osm_file.write(' </node>\n')
+            else:
+                osm_file.write(' <node %s/>\n' % attributes)
+            counts['nodes'] += 1
+            counts['tags'] += len(tags)
+
+        way_id = n_nodes + 1
+        for _ in range(int(n_nodes * way_ratio)):
+            osm_file.write(' <way %s>\n' % _attributes(rng, way_id, rng.randrange(len(USERS))))
+            first = rng.randint(1, n_nodes)
+            for i in range(max(2, int(rng.gauss(nodes_per_way, nodes_per_way / 4.0)))):
+                osm_file.write('  <nd ref="%d"/>\n' % min(first + i, n_nodes))
+            tags = list(_tags(rng, tag_density * 2, dirty_ratio))
+            for k, v in tags:
+                osm_file.write('  <tag k=%s v=%s/>\n' % (quoteattr(k), quoteattr(v)))
+            osm_file.write(' </way>\n')
+            way_id += 1
+            counts['ways'] += 1
+            counts['tags'] += len(tags)
+
+        osm_file.write('</osm>\n')
+    return counts
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Dictionary encoding and full-text index of the tag tables.
+
+encode_tags interns the tag keys, types and values of nodes_tags and
+ways_tags into dictionary tables with integer ids, replaces the two tables
+with integer-only tables clustered on their primary key and covering
+indexes, and adds an FTS5 trigram index over the distinct values for
+substring search. nodes_tags and ways_tags become views with the same
+columns, backed by triggers for inserts, updates and deletes, so existing
+queries and incremental loads keep working.
+
+An element has a single tag per key and type, so the primary key (id,
+key_id, value_id, type_id) never rejects a loaded tag row, and changing the
+value of a row (the update trigger, reclean_db) cannot collide with another
+row of the element. A table with duplicate tag rows is left unencoded and
+encode_tags raises sqlite3.IntegrityError.
+
+Substring searches such as value LIKE '%restaurant%' then only scan the
+index of distinct values instead of every tag row, see query_db.search_tags.
+"""
+
+
+TAG_TABLES = ('nodes_tags', 'ways_tags')
+
+SQL_DICTIONARY = """
+CREATE TABLE IF NOT EXISTS tag_keys (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS tag_types (id INTEGER PRIMARY KEY, type TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS tag_values (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE);
+"""
+
+SQL_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tag_values_fts
+    USING fts5(value, content='tag_values', content_rowid='id', tokenize='{tokenizer}');
+INSERT INTO tag_values_fts(tag_values_fts) VALUES ('rebuild');
+CREATE TRIGGER IF NOT EXISTS tag_values_fts_insert AFTER INSERT ON tag_values BEGIN
+    INSERT INTO tag_values_fts(rowid, value) VALUES (NEW.id, NEW.value);
+END;
+"""
+
+SQL_ENCODE = """
+CREATE TABLE {table}_enc (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    value_id INTEGER NOT NULL,
+    type_id INTEGER NOT NULL,
+    PRIMARY KEY (id, key_id, value_id, type_id)
+) WITHOUT ROWID;
+
+INSERT INTO {table}_enc (id, key_id, value_id, type_id)
+SELECT t.id, k.id, v.id, ty.id FROM {table} t
+JOIN tag_keys k ON k.key = t.key
+JOIN tag_values v ON v.value = t.value
+JOIN tag_types ty ON ty.type = t.type;
+
+DROP TABLE {table};
+
+CREATE INDEX {table}_enc_key ON {table}_enc (key_id, value_id, id);
+CREATE INDEX {table}_enc_value ON {table}_enc (value_id, key_id, id);
+
+CREATE VIEW {table} AS
+SELECT t.id AS id, k.key AS key, v.value AS value, ty.type AS type
+FROM {table}_enc t
+JOIN tag_keys k ON k.id = t.key_id
+JOIN tag_values v ON v.id = t.value_id
+JOIN tag_types ty ON ty.id = t.type_id;
+
+CREATE TRIGGER {table}_insert INSTEAD OF INSERT ON {table} BEGIN
+    INSERT OR IGNORE INTO tag_keys (key) VALUES (NEW.key);
+    INSERT OR IGNORE INTO tag_values (value) VALUES (NEW.value);
+    INSERT OR IGNORE INTO tag_types (type) VALUES (NEW.type);
+    INSERT INTO {table}_enc (id, key_id, value_id, type_id) VALUES (
+        NEW.id,
+        (SELECT id FROM tag_keys WHERE key = NEW.key),
+        (SELECT id FROM tag_values WHERE value = NEW.value),
+        (SELECT id FROM tag_types WHERE type = NEW.type));
+END;
+
+CREATE TRIGGER {table}_delete INSTEAD OF DELETE ON {table} BEGIN
+    DELETE FROM {table}_enc WHERE id = OLD.id
+        AND key_id = (SELECT id FROM tag_keys WHERE key = OLD.key)
+        AND value_id = (SELECT id FROM tag_values WHERE value = OLD.value)
+        AND type_id = (SELECT id FROM tag_types WHERE type = OLD.type);
+END;
+
+CREATE TRIGGER {table}_update INSTEAD OF UPDATE OF value ON {table} BEGIN
+    INSERT OR IGNORE INTO tag_values (value) VALUES (NEW.value);
+    UPDATE {table}_enc SET value_id = (SELECT id FROM tag_values WHERE value = NEW.value)
+    WHERE id = OLD.id
+        AND key_id = (SELECT id FROM tag_keys WHERE key = OLD.key)
+        AND value_id = (SELECT id FROM tag_values WHERE value = OLD.value)
+        AND type_id = (SELECT id FROM tag_types WHERE type = OLD.type);
+END;
+"""
+
+
+def is_encoded(conn, table='nodes_tags'):
+    """Return True if a tag table has been replaced by its encoded view"""
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+    return row is not None and row[0] == 'view'
+
+
+def _fts_tokenizer(conn):
+    """Use the trigram tokenizer for substring search when SQLite provides it"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.trigram_check USING fts5(value, tokenize='trigram')")
+    except Exception:
+        return 'unicode61'
+    conn.execute("DROP TABLE temp.trigram_check")
+    return 'trigram'
+
+
+def encode_tags(conn, vacuum=True):
+    """
+    Replace the tag tables of a loaded database with their dictionary encoding.
+    Args:
+        conn: connection to the OSM database
+        vacuum (bool): reclaim the space freed by the old tables
+    """
+    tables = [table for table in TAG_TABLES if not is_encoded(conn, table)]
+    if not tables:
+        return
+
+    conn.executescript(SQL_DICTIONARY)
+    conn.execute("BEGIN")
+    for table in tables:
+        conn.execute("INSERT OR IGNORE INTO tag_keys (key) SELECT DISTINCT key FROM %s" % table)
+        conn.execute("INSERT OR IGNORE INTO tag_types (type) SELECT DISTINCT type FROM %s" % table)
+        conn.execute("INSERT OR IGNORE INTO tag_values (value) SELECT DISTINCT value FROM %s" % table)
+    conn.execute("COMMIT")
+
+    conn.executescript(SQL_FTS.format(tokenizer=_fts_tokenizer(conn)))
+    for table in tables:
+        try:
+            conn.executescript("BEGIN;" + SQL_ENCODE.format(table=table) + "COMMIT;")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    if vacuum:
+        conn.execute("VACUUM")